@@ -1,10 +1,16 @@
 # app.py
 
-from flask import Flask, jsonify, request, send_from_directory
+from flask import Flask, Response, jsonify, request, send_from_directory
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 import logging
 import json
 import os
+import threading
+from functools import lru_cache, partial
+from typing import Callable, NamedTuple
 
 app = Flask(__name__, static_folder='static')
 
@@ -14,13 +20,59 @@ logging.basicConfig(level=logging.INFO)
 # Path to the pipeline status file within the output directory
 STATUS_FILE_PATH = "output/pipeline_status.json"
 
-# Path to the annotated variants file
-VARIANTS_FILE_PATH = "output/annotated_variants.tsv"
+# Path to the annotated variants file written by the pipeline (Parquet; a TSV path is also accepted)
+VARIANTS_FILE_PATH = "output/annotated_variants.parquet"
+
+# Pattern splitting a Frequency cell such as "0.01 (gnomADe:NFE)" into value and population
+FREQUENCY_PATTERN = r'^\s*([-+0-9.eE]+)(?:\s*\(\s*(?:Population:\s*)?([^)]*)\))?\s*$'
+
+# Column types of the annotated variants TSV; Frequency and DP are parsed after reading
+VARIANTS_DTYPES = {
+    "CHROM": "string[pyarrow]",
+    "POS": "int64",
+    "ID": "string[pyarrow]",
+    "REF": "string[pyarrow]",
+    "ALT": "string[pyarrow]",
+    "Gene": "string[pyarrow]",
+    "Frequency": "string[pyarrow]",
+    "DP": "string[pyarrow]",
+}
+
+# Column types of variants read from pipeline Parquet output, matching what parse_variants produces for a TSV
+PARQUET_VARIANTS_DTYPES = {**VARIANTS_DTYPES, "Frequency": "Float32", "Population": "string[pyarrow]", "DP": "Int32"}
+
+# Pandas dtypes for Arrow text columns read from Parquet, so parsed and Parquet-loaded frames share string dtypes
+ARROW_STRING_DTYPES = {pa.string(): pd.StringDtype("pyarrow"), pa.large_string(): pd.StringDtype("pyarrow")}
+
+# Low-cardinality text columns stored as categoricals (integer codes plus one copy of each label)
+CATEGORY_COLUMNS = ["CHROM", "Gene", "Population", "REF", "ALT"]
+
+# Number of sorted rows checked against the filter mask at a time when selecting a page
+PAGE_SCAN_CHUNK_SIZE = 65536
+
+# Number of rendered /variants response bodies kept per loaded variants frame
+PAGE_CACHE_SIZE = 256
+
+# Largest per_page whose rendered bodies are cached; bigger pages are rendered on every request
+PAGE_CACHE_MAX_PER_PAGE = 1000
+
+# Suffix replacing ".tsv" in the name of the Parquet cache of a parsed variants TSV
+CACHE_FILE_SUFFIX = ".cache.parquet"
+
+# Suffix of the sidecar file recording which TSV mtime a Parquet cache was built from
+CACHE_MTIME_SUFFIX = ".mtime"
 
 # Allowed columns for sorting
 ALLOWED_SORT_COLUMNS = ["CHROM", "POS", "ID", "REF", "ALT", "Gene", "Frequency", "Population", "DP"]
 ALLOWED_SORT_ORDERS = ["asc", "desc"]
 
+# Filter operators accepted by the frequency_operator and depth_operator parameters, as numpy comparisons
+FILTER_OPERATORS = {
+    "le": np.less_equal,
+    "ge": np.greater_equal,
+    "eq": np.equal,
+}
+
 # Helper function for parameter validation
 def validate_query_param(param_value, param_name, expected_type, positive=False, min_value=None, max_value=None):
     if param_value is not None:
@@ -55,64 +107,300 @@ def validate_query_param(param_value, param_name, expected_type, positive=False,
     return None
 
 def validate_operator_param(param_value, param_name):
-    allowed_values = ['le', 'ge', 'eq']
+    allowed_values = list(FILTER_OPERATORS)
     if param_value not in allowed_values:
         raise ValueError(f"Invalid query parameter: '{param_name}' must be one of {allowed_values}.")
     return param_value
 
-def apply_operator(series, operator, value):
-    if operator == 'le':
-        return series <= value
-    elif operator == 'ge':
-        return series >= value
-    elif operator == 'eq':
-        return series == value
-    else:
-        # Should not reach here if validation is correct
-        raise ValueError(f"Invalid operator: {operator}")
+def count_comment_lines(file_path):
+    """Count the leading '#' lines (e.g. the dbSNP version) preceding the TSV header."""
+    count = 0
+    with open(file_path, 'r') as tsv_file:
+        for line in tsv_file:
+            if not line.startswith('#'):
+                break
+            count += 1
+    return count
+
+def get_cache_path(file_path):
+    """Return the path of the Parquet cache for a variants TSV.
+
+    The name differs from the pipeline's own Parquet output next to the TSV, which the cache must never replace.
+    """
+    return os.path.splitext(file_path)[0] + CACHE_FILE_SUFFIX
+
+def read_variants_cache(file_path, mtime):
+    """Return the cached parsed variants if the cache was built from this TSV mtime, else None."""
+    cache_path = get_cache_path(file_path)
+    try:
+        with open(cache_path + CACHE_MTIME_SUFFIX, 'r') as mtime_file:
+            if float(mtime_file.read()) != mtime:
+                return None
+        return read_parquet_frame(cache_path)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        logging.warning(f"Ignoring unreadable variants cache '{cache_path}': {e}")
+        return None
+
+def write_variants_cache(df, file_path, mtime):
+    """Persist the parsed variants as Parquet, tagged with the TSV mtime it was built from."""
+    cache_path = get_cache_path(file_path)
+    try:
+        # Write to temporary files first so concurrent workers never read a partial cache
+        tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+        df.to_parquet(tmp_path, engine='pyarrow', compression='zstd', index=False)
+        os.replace(tmp_path, cache_path)
+        with open(tmp_path, 'w') as mtime_file:
+            mtime_file.write(repr(mtime))
+        os.replace(tmp_path, cache_path + CACHE_MTIME_SUFFIX)
+    except Exception as e:
+        logging.warning(f"Failed to write variants cache '{cache_path}': {e}")
+
+def read_parquet_frame(file_path):
+    """Read a Parquet file into a DataFrame with its text columns as Arrow-backed strings."""
+    return pq.read_table(file_path).to_pandas(types_mapper=ARROW_STRING_DTYPES.get)
+
+def parse_variants(file_path):
+    """Read the annotated variants TSV and parse its Frequency and DP columns."""
+    # The pyarrow engine has no 'comment' option, so the leading comment lines are skipped via 'header'
+    df = pd.read_csv(file_path, sep="\t", header=count_comment_lines(file_path),
+                     engine='pyarrow', dtype=VARIANTS_DTYPES)
+
+    # Parse the Frequency column ("<value> (<population>)") into value and population
+    extracted = df['Frequency'].astype('string[pyarrow]').str.extract(FREQUENCY_PATTERN)
+    # Single precision is plenty for population frequencies and halves the bytes each filter and sort reads
+    df['Frequency'] = pd.to_numeric(extracted[0], errors='coerce').astype('Float32')
+    df['Population'] = extracted[1].fillna('N/A')
+    df.loc[df['Frequency'].isna(), 'Population'] = 'N/A'
+
+    # Parse the DP column ("[10]" or "10"); 'N/A'/'NA' become missing values.
+    # Nullable Int32 keeps DP integral through filtering and the Parquet cache round-trip
+    df['DP'] = pd.to_numeric(df['DP'].astype('string[pyarrow]').str.strip().str.strip('[]'), errors='coerce').astype('Int32')
+
+    return df
+
+def read_variants_parquet(file_path):
+    """Read variants the pipeline wrote as typed Parquet; no text parsing is needed."""
+    df = read_parquet_frame(file_path).astype(PARQUET_VARIANTS_DTYPES)
+    df['Population'] = df['Population'].fillna('N/A')
+    return df
+
+def column_filter_values(column):
+    """Return a numeric column as a float ndarray in its own precision (at least float32), missing values as NaN.
+
+    float32 columns stay float32 so query values are rounded the same way as the stored values.
+    """
+    dtype = np.result_type(getattr(column.dtype, 'numpy_dtype', column.dtype), np.float32)
+    return column.to_numpy(dtype=dtype, na_value=np.nan)
+
+def widen_float32_columns(df):
+    """Return df with float32 columns converted to float64 through their shortest decimal form.
+
+    JSON then shows a stored 0.1 as 0.1 rather than as the float32 value 0.1000000015.
+    """
+    float32_columns = [column for column, dtype in df.dtypes.items() if dtype in ("Float32", "float32")]
+    if not float32_columns:
+        return df
+    return df.assign(**{column: pd.to_numeric(df[column].astype("string[pyarrow]")) for column in float32_columns})
+
+def get_filter_values(variants_df, column):
+    """Return column_filter_values for a column, reusing the ndarray already built for the shared frame."""
+    cache = _variants_cache
+    if cache is None or cache.df is not variants_df:
+        return column_filter_values(variants_df[column])
+
+    filter_values = cache.filter_values
+    if column not in filter_values:
+        filter_values[column] = column_filter_values(variants_df[column])
+    return filter_values[column]
+
+def build_filter_mask(variants_df, frequency, frequency_operator, depth, depth_operator):
+    """Return a boolean row mask for the frequency and depth filters (None disables a filter).
+
+    Missing values are compared as NaN, which fails every operator, so they are
+    excluded without a separate notna pass.
+    """
+    mask = np.ones(len(variants_df), dtype=bool)
+    for column, operator, value in (("Frequency", frequency_operator, frequency), ("DP", depth_operator, depth)):
+        if value is not None:
+            values = get_filter_values(variants_df, column)
+            mask &= FILTER_OPERATORS[operator](values, value)
+    return mask
 
 def load_variants(file_path):
     if not os.path.exists(file_path):
         return pd.DataFrame()  # Return empty DataFrame if file doesn't exist
 
-    df = pd.read_csv(file_path, sep="\t", comment="#")
-
-    # Parse the Frequency column
-    def parse_frequency(freq_str):
-        if pd.isnull(freq_str) or freq_str in ['N/A', 'NA']:
-            return pd.NA, 'N/A'
-        else:
-            try:
-                # Split by ' (' to separate frequency value and population
-                parts = freq_str.split(' (')
-                freq_value = float(parts[0].strip())
-                population = parts[1].rstrip(')') if len(parts) > 1 else 'N/A'
-                return freq_value, population
-            except Exception as e:
-                logging.error(f"Error parsing frequency '{freq_str}': {e}")
-                return pd.NA, 'N/A'
-
-    freq_parsed = df['Frequency'].apply(parse_frequency)
-    df['Frequency'], df['Population'] = zip(*freq_parsed)
-    df['Frequency'] = pd.to_numeric(df['Frequency'], errors='coerce')
-
-    # Parse the DP column
-    def parse_dp(dp_str):
-        if pd.isnull(dp_str) or dp_str in ['N/A', 'NA']:
-            return pd.NA
-        else:
-            try:
-                dp_str = dp_str.strip('[]')
-                dp_value = int(dp_str)
-                return dp_value
-            except Exception as e:
-                logging.error(f"Error parsing DP '{dp_str}': {e}")
-                return pd.NA
-
-    df['DP'] = df['DP'].apply(parse_dp)
+    if file_path.endswith('.parquet'):
+        df = read_variants_parquet(file_path)
+    else:
+        # Reuse the parsed Parquet cache unless the TSV changed since it was written
+        try:
+            mtime = os.path.getmtime(file_path)
+        except OSError:
+            mtime = None
+        df = read_variants_cache(file_path, mtime) if mtime is not None else None
+        if df is None:
+            df = parse_variants(file_path)
+            if mtime is not None:
+                write_variants_cache(df, file_path, mtime)
+
+    # Repeated labels become integer codes, which shrinks the frame and makes sorting and comparisons cheap.
+    # Converted after the cache so fresh and cached loads get identical dtypes
+    for column in CATEGORY_COLUMNS:
+        if column in df.columns:
+            df[column] = df[column].astype('category')
+
+    # Index rows by variant ID so single-variant lookups are hash probes instead of column scans.
+    # The index is left unnamed so 'ID' stays unambiguous as a sort column.
+    df.index = df['ID'].rename(None)
 
     return df
 
+class VariantsCache(NamedTuple):
+    """Variants loaded from one version of the TSV, with the work derived from them."""
+    mtime: float  # modification time of the variants file
+    df: pd.DataFrame
+    sort_orders: dict  # {(sort column, ascending): cached sort order}
+    filter_values: dict  # {filter column: cached ndarray}
+    render_page: Callable[..., str]  # LRU-cached render_variants_page bound to df
+
+# Variants loaded on first use and shared by all requests
+_variants_cache = None
+_variants_lock = threading.Lock()
+
+def get_variants_df():
+    """Return the shared variants DataFrame, (re)loading it when the TSV changes on disk."""
+    global _variants_cache
+    try:
+        mtime = os.path.getmtime(VARIANTS_FILE_PATH)
+    except OSError:
+        # Nothing to cache until the pipeline has written its output
+        return load_variants(VARIANTS_FILE_PATH)
+
+    cache = _variants_cache
+    if cache is not None and cache.mtime == mtime:
+        return cache.df
+    with _variants_lock:
+        # Another request may have loaded the data while we waited for the lock
+        cache = _variants_cache
+        if cache is None or cache.mtime != mtime:
+            variants_df = load_variants(VARIANTS_FILE_PATH)
+            render_page = lru_cache(maxsize=PAGE_CACHE_SIZE)(partial(render_variants_page, variants_df))
+            cache = VariantsCache(mtime, variants_df, {}, {}, render_page)
+            _variants_cache = cache
+        return cache.df
+
+# Parsed pipeline status shared by all requests, as ((mtime_ns, size) of the status file, status dict)
+_status_cache = None
+
+def read_pipeline_status():
+    """Return the parsed pipeline status file, or None if it doesn't exist.
+
+    The file is only re-read when its modification time or size changes.
+    """
+    global _status_cache
+    if not os.path.exists(STATUS_FILE_PATH):
+        return None
+    try:
+        stat_result = os.stat(STATUS_FILE_PATH)
+        signature = (stat_result.st_mtime_ns, stat_result.st_size)
+    except OSError:
+        signature = None
+
+    cache = _status_cache
+    if signature is not None and cache is not None and cache[0] == signature:
+        return cache[1]
+    with open(STATUS_FILE_PATH, 'r') as status_file:
+        status_data = json.load(status_file)
+    if signature is not None:
+        _status_cache = (signature, status_data)
+    return status_data
+
+def compute_sort_order(variants_df, sort_column, ascending):
+    """Return the row positions sorting variants_df by sort_column, with missing values last."""
+    column = variants_df[sort_column].reset_index(drop=True)
+    order = column.sort_values(kind='stable', na_position='last').index.to_numpy()
+    if ascending:
+        return order
+    valid_count = int(column.notna().sum())
+    return np.concatenate([order[:valid_count][::-1], order[valid_count:]])
+
+def get_sort_order(variants_df, sort_column, ascending):
+    """Return the row positions sorting variants_df by sort_column, with missing values last.
+
+    Orders for the shared frame are computed once per column and direction and reused by later requests.
+    """
+    cache = _variants_cache
+    if cache is None or cache.df is not variants_df:
+        return compute_sort_order(variants_df, sort_column, ascending)
+
+    sort_orders = cache.sort_orders
+    key = (sort_column, ascending)
+    if key not in sort_orders:
+        sort_orders[key] = compute_sort_order(variants_df, sort_column, ascending)
+    return sort_orders[key]
+
+def select_page_positions(order, mask, start, end):
+    """Return the start:end slice of the rows in order that pass mask.
+
+    The order is scanned in chunks and the scan stops once the page is filled,
+    so early pages do not pay for filtering the whole sorted order.
+    """
+    matches = []
+    found = 0
+    for chunk_start in range(0, len(order), PAGE_SCAN_CHUNK_SIZE):
+        chunk = order[chunk_start:chunk_start + PAGE_SCAN_CHUNK_SIZE]
+        chunk_matches = chunk[mask[chunk]]
+        matches.append(chunk_matches)
+        found += len(chunk_matches)
+        if found >= end:
+            break
+    if not matches:
+        return order[:0]
+    return np.concatenate(matches)[start:end]
+
+def render_variants_page(variants_df, frequency, frequency_operator, depth, depth_operator,
+                         page, per_page, sort_column, sort_order):
+    """Return the JSON body of one page of filtered, sorted variants."""
+    # Combine all filters into one row mask over the shared frame
+    mask = build_filter_mask(variants_df, frequency, frequency_operator, depth, depth_operator)
+
+    # Pagination
+    total_variants = int(np.count_nonzero(mask))
+    total_pages = (total_variants + per_page - 1) // per_page
+    start = (page - 1) * per_page
+    end = start + per_page
+
+    # Row positions of the requested page, in output order
+    if sort_column:
+        order = get_sort_order(variants_df, sort_column, ascending=(sort_order == 'asc'))
+        if frequency is not None or depth is not None:
+            page_positions = select_page_positions(order, mask, start, end)
+        else:
+            page_positions = order[start:end]
+    else:
+        page_positions = np.flatnonzero(mask)[start:end]
+    paginated_variants = widen_float32_columns(variants_df.take(page_positions))
+
+    # Serialize the page with pandas' JSON writer (missing values become null) and wrap it in the response envelope
+    variants_json = paginated_variants.to_json(orient="records")
+    return (
+        f'{{"page":{page},"per_page":{per_page},"total_variants":{total_variants},'
+        f'"total_pages":{total_pages},"variants":{variants_json}}}'
+    )
+
+def get_variants_page(variants_df, frequency, frequency_operator, depth, depth_operator,
+                      page, per_page, sort_column, sort_order):
+    """Return a page body from render_variants_page, reusing bodies already rendered from the shared frame."""
+    page_args = (frequency, frequency_operator, depth, depth_operator, page, per_page, sort_column, sort_order)
+    cache = _variants_cache
+    # Huge pages are not kept, so a few of them can't pin serialized copies of the whole dataset
+    if cache is None or cache.df is not variants_df or per_page > PAGE_CACHE_MAX_PER_PAGE:
+        return render_variants_page(variants_df, *page_args)
+    return cache.render_page(*page_args)
+
 @app.route("/variants", methods=["GET"])
 def get_variants():
     try:
@@ -155,63 +443,27 @@ def get_variants():
             return jsonify({"message": str(ve)}), 400
 
         # Check pipeline status
-        status_data = {}
-        if os.path.exists(STATUS_FILE_PATH):
-            with open(STATUS_FILE_PATH, 'r') as status_file:
-                status_data = json.load(status_file)
+        status_data = read_pipeline_status()
+        if status_data is not None:
             if status_data['status'] == 'running':
                 return jsonify({"message": status_data['message']}), 202  # 202 Accepted
             elif status_data['status'] == 'failed':
                 return jsonify({"message": status_data['message']}), 500  # 500 Internal Server Error
         else:
             # If status file doesn't exist, assume idle or no data
-            pass
+            status_data = {}
 
         # Load variants data
-        variants_df = load_variants(VARIANTS_FILE_PATH)
+        variants_df = get_variants_df()
         if variants_df.empty:
             if status_data.get('status') == 'completed':
                 return jsonify({"message": "Pipeline has completed but no data found."}), 503
             else:
                 return jsonify({"message": "Pipeline has not been run yet."}), 503  # 503 Service Unavailable
 
-        # Start with the full dataset
-        filtered_variants = variants_df.copy()
-
-        # Apply frequency filter if provided
-        if frequency is not None:
-            frequency_series = filtered_variants["Frequency"]
-            frequency_mask = frequency_series.notna() & apply_operator(frequency_series, frequency_operator, frequency)
-            filtered_variants = filtered_variants[frequency_mask]
-
-        # Apply depth filter if provided
-        if depth is not None:
-            depth_series = filtered_variants["DP"]
-            depth_mask = depth_series.notna() & apply_operator(depth_series, depth_operator, depth)
-            filtered_variants = filtered_variants[depth_mask]
-
-        # Apply sorting if provided
-        if sort_column:
-            ascending = True if sort_order == 'asc' else False
-            filtered_variants = filtered_variants.sort_values(by=sort_column, ascending=ascending)
-
-        # Pagination
-        total_variants = len(filtered_variants)
-        total_pages = (total_variants + per_page - 1) // per_page
-        start = (page - 1) * per_page
-        end = start + per_page
-        paginated_variants = filtered_variants.iloc[start:end].replace({pd.NA: None, float('nan'): None})
-
-        # Prepare the response
-        response = {
-            "page": page,
-            "per_page": per_page,
-            "total_variants": total_variants,
-            "total_pages": total_pages,
-            "variants": paginated_variants.to_dict(orient="records")
-        }
-
-        return jsonify(response)
+        response_body = get_variants_page(variants_df, frequency, frequency_operator, depth, depth_operator,
+                                          page, per_page, sort_column, sort_order)
+        return Response(response_body, mimetype="application/json")
 
     except Exception as e:
         logging.error(f"Error retrieving variants: {e}")
@@ -221,20 +473,19 @@ def get_variants():
 def get_variant(variant_id):
     try:
         # Load variants data
-        variants_df = load_variants(VARIANTS_FILE_PATH)
+        variants_df = get_variants_df()
         if variants_df.empty:
             return jsonify({"message": "No variants data available."}), 503
 
-        variant = variants_df[variants_df["ID"] == variant_id]
-        if not variant.empty:
-            # Replace NaN with None
-            variant_dict = variant.to_dict(orient="records")[0]
-            for key, value in variant_dict.items():
-                if pd.isna(value):
-                    variant_dict[key] = None
-            return jsonify(variant_dict)
-        else:
+        try:
+            # Several rows can share an ID (e.g. '.'); the first one is returned
+            variant = variants_df.loc[[variant_id]].iloc[:1]
+        except KeyError:
             return jsonify({"message": "Variant not found."}), 404
+
+        # Serialize the row directly; missing values become null and float32 values keep their short form
+        row = widen_float32_columns(variant).iloc[0]
+        return Response(row.to_json(), mimetype="application/json")
     except Exception as e:
         logging.error(f"Error retrieving variant {variant_id}: {e}")
         return jsonify({"message": "Internal server error."}), 500
@@ -242,9 +493,8 @@ def get_variant(variant_id):
 @app.route("/status", methods=["GET"])
 def get_status():
     try:
-        if os.path.exists(STATUS_FILE_PATH):
-            with open(STATUS_FILE_PATH, 'r') as status_file:
-                status_data = json.load(status_file)
+        status_data = read_pipeline_status()
+        if status_data is not None:
             return jsonify(status_data), 200
         else:
             # If status file doesn't exist
@@ -8,16 +8,25 @@ import requests
 from requests.adapters import HTTPAdapter
 from urllib3.util.retry import Retry
 from cyvcf2 import VCF
-import json
+import orjson
 import threading
+import queue
 from concurrent.futures import ThreadPoolExecutor, as_completed
 import os
 import traceback
 import argparse
+import atexit
 import random
 import re
+import sqlite3
+from functools import lru_cache
+from operator import itemgetter
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 
-from ensembl_client import EnsemblRestClient  # Ensure this file is in the same directory or PYTHONPATH
+from ensembl_client import EnsemblRestClient, PayloadTooLargeError, truncate_text  # Ensure this file is in the same directory or PYTHONPATH
+from annotation_cache import AnnotationCache
 
 # ================================
 # Logging Configuration
@@ -27,17 +36,61 @@ from ensembl_client import EnsemblRestClient  # Ensure this file is in the same
 logger = logging.getLogger()
 logger.setLevel(logging.DEBUG)
 
+# The handlers are named so that loading this module a second time (e.g. run as a script
+# and imported) doesn't attach them again and print every line twice
+_handler_names = {handler.get_name() for handler in logger.handlers}
+
 # Console handler for general logs (INFO and above)
-ch = logging.StreamHandler(sys.stdout)
-ch.setLevel(logging.INFO)
-ch.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
-logger.addHandler(ch)
+if 'annotate_console' not in _handler_names:
+    ch = logging.StreamHandler(sys.stdout)
+    ch.set_name('annotate_console')
+    ch.setLevel(logging.INFO)
+    ch.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+    logger.addHandler(ch)
 
 # File handler for detailed logs (DEBUG and above)
-fh = logging.FileHandler('logs/detailed_logs.log')
-fh.setLevel(logging.DEBUG)
-fh.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
-logger.addHandler(fh)
+if 'annotate_detailed_file' not in _handler_names:
+    fh = logging.FileHandler('logs/detailed_logs.log')
+    fh.set_name('annotate_detailed_file')
+    fh.setLevel(logging.DEBUG)
+    fh.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+    logger.addHandler(fh)
+
+# ================================
+# Output Settings
+# ================================
+
+OUTPUT_COLUMNS = ['CHROM', 'POS', 'ID', 'REF', 'ALT', 'Gene', 'Frequency', 'DP']
+
+# Typed columns of Parquet output; Frequency and Population are stored separately
+# instead of the TSV's combined "<frequency> (<population>)" text
+OUTPUT_PARQUET_SCHEMA = pa.schema([
+    ('CHROM', pa.string()),
+    ('POS', pa.int32()),
+    ('ID', pa.string()),
+    ('REF', pa.string()),
+    ('ALT', pa.string()),
+    ('Gene', pa.string()),
+    ('Frequency', pa.float32()),
+    ('Population', pa.string()),
+    ('DP', pa.int32()),
+])
+
+# Default --cache_dir (following the XDG convention) and the file name of the response cache created inside it
+DEFAULT_CACHE_DIR = os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'), 'varannotator')
+CACHE_FILE_NAME = 'ensembl_responses.sqlite'
+
+# Attempts made for a variation batch before it is recorded as failed, and the
+# exponential backoff (seconds) between them
+VARIATION_MAX_ATTEMPTS = 5
+RETRY_BACKOFF_BASE = 1
+RETRY_BACKOFF_CAP = 30
+
+# Seconds a cached dbSNP version is trusted; NCBI publishes a new build every few months at most
+DBSNP_VERSION_TTL = 7 * 24 * 60 * 60
+
+# Number of annotated rows formatted and written to the output file at a time
+WRITE_CHUNK_SIZE = 100_000
 
 # ================================
 # Failed Batches Tracking
@@ -45,28 +98,85 @@ logger.addHandler(fh)
 
 # List to store failed batches with their attempt counts
 failed_batches = []
-failed_batches_lock = threading.Lock()
 
 # ================================
 # Helper Functions
 # ================================
 
+# API times logs stay open for the whole run (one buffered handle, csv writer and count of
+# unflushed entries per path); worker threads share them under a single lock
+_api_time_logs = {}
+_api_time_logs_lock = threading.Lock()
+
+# Entries buffered before an API times log is flushed, so a killed run loses at most this many
+API_TIME_LOG_FLUSH_EVERY = 50
+
 def log_api_time(api_type, duration, output_log="logs/api_times_log.tsv"):
     """Log the duration of API calls."""
     try:
-        with open(output_log, 'a', newline='') as log_file:
-            writer = csv.writer(log_file, delimiter='\t')
-            writer.writerow([api_type, f"{duration:.4f}"])
+        with _api_time_logs_lock:
+            if output_log not in _api_time_logs:
+                log_file = open(output_log, 'a', newline='', buffering=1 << 16)
+                _api_time_logs[output_log] = [log_file, csv.writer(log_file, delimiter='\t'), 0]
+            api_time_log = _api_time_logs[output_log]
+            api_time_log[1].writerow([api_type, f"{duration:.4f}"])
+            api_time_log[2] += 1
+            if api_time_log[2] >= API_TIME_LOG_FLUSH_EVERY:
+                api_time_log[0].flush()
+                api_time_log[2] = 0
     except Exception as e:
         logger.error(f"Failed to write to API times log: {e}")
 
+def close_api_time_logs():
+    """Flush and close the API times logs opened by log_api_time."""
+    with _api_time_logs_lock:
+        for log_file, _, _ in _api_time_logs.values():
+            log_file.close()
+        _api_time_logs.clear()
+
+atexit.register(close_api_time_logs)
+
+def cache_get_many(cache, namespace, keys):
+    """Look keys up in the response cache; a cache error is logged and treated as a miss."""
+    if cache is None:
+        return {}
+    try:
+        return cache.get_many(namespace, keys)
+    except sqlite3.Error as e:
+        # e.g. 'database is locked' while another annotate job writes to the same cache file
+        logger.warning(f"Ignoring unreadable '{namespace}' entries in the response cache: {e}")
+        return {}
+
+def cache_set_many(cache, namespace, items, ttl=None):
+    """Store responses in the response cache; a cache error is logged and the responses are just not kept."""
+    if cache is None:
+        return
+    try:
+        cache.set_many(namespace, items, ttl=ttl)
+    except sqlite3.Error as e:
+        logger.warning(f"Failed to store '{namespace}' entries in the response cache: {e}")
+
+def positive_int(value):
+    """argparse type accepting integers of at least 1."""
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be a positive integer, got {value}")
+    return number
+
 def parse_arguments():
     parser = argparse.ArgumentParser(description="Annotate VCF variants using Ensembl VEP and population frequencies.")
     parser.add_argument('input_vcf', help='Path to input VCF file')
-    parser.add_argument('output_tsv', help='Path to output TSV file')
-    parser.add_argument('--batch_size', type=int, default=25, help='Number of variants per API request (default: 25)')
-    parser.add_argument('--max_workers', type=int, default=15, help='Number of worker threads for parallel processing (default: 15)')
-    parser.add_argument('--reqs_per_sec', type=int, default=15, help='API requests per second (default: 15)')
+    parser.add_argument('output_tsv', help='Path to output file; written as Parquet if it ends in .parquet, otherwise as TSV')
+    parser.add_argument('--batch_size', type=positive_int, default=200,
+                        help='Number of variants per API request; 200 is the Ensembl POST maximum (default: 200)')
+    parser.add_argument('--max_workers', type=positive_int, default=None,
+                        help='Number of worker threads for parallel processing (default: twice --reqs_per_sec, at most 32)')
+    parser.add_argument('--reqs_per_sec', type=positive_int, default=15, help='API requests per second (default: 15)')
+    parser.add_argument('--cache_dir', default=DEFAULT_CACHE_DIR,
+                        help=f'Directory for an on-disk cache of Ensembl responses reused across runs (default: {DEFAULT_CACHE_DIR})')
+    parser.add_argument('--no_cache', action='store_true', help='Always query Ensembl; neither read nor write the response cache')
+    parser.add_argument('--refresh_cache', action='store_true',
+                        help='Always query Ensembl, replacing the cached responses with the new ones')
     parser.add_argument('--target_populations', nargs='*', default=["gnomADe:NFE", "gnomADg:NFE", "1000GENOMES:phase_3:CEU"],
                         help='Target populations for frequency data')
     return parser.parse_args()
@@ -75,36 +185,39 @@ def is_valid_rsid(rsid):
     """Validate the format of an rsID."""
     return bool(re.match(r'^rs\d+$', rsid))
 
+# Translation table used by complement_allele
+COMPLEMENT_TABLE = bytes.maketrans(b'ACGT-', b'TGCA-')
+
+@lru_cache(maxsize=1 << 14)
 def normalize_alleles(ref, alt):
     """Normalize alleles by removing common prefix and suffix nucleotides."""
     ref = ref.upper()
     alt = alt.upper()
 
-    while len(ref) > 1 and len(alt) > 1 and ref[-1] == alt[-1]:
-        ref = ref[:-1]
-        alt = alt[:-1]
-
-    while len(ref) > 1 and len(alt) > 1 and ref[0] == alt[0]:
-        ref = ref[1:]
-        alt = alt[1:]
-
-    logger.debug(f"Normalized alleles - REF: {ref}, ALT: {alt}")
+    # Measure the shared suffix, then the shared prefix of what remains, and slice once.
+    # At least one base of each allele is always kept.
+    max_trim = min(len(ref), len(alt)) - 1
+    suffix = 0
+    while suffix < max_trim and ref[-1 - suffix] == alt[-1 - suffix]:
+        suffix += 1
+    prefix = 0
+    while prefix < max_trim - suffix and ref[prefix] == alt[prefix]:
+        prefix += 1
+    ref = ref[prefix:len(ref) - suffix]
+    alt = alt[prefix:len(alt) - suffix]
+
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(f"Normalized alleles - REF: {ref}, ALT: {alt}")
     return ref, alt
 
+@lru_cache(maxsize=1 << 14)
 def complement_allele(allele):
     """Return the complement of the given DNA sequence."""
-    complement = str.maketrans('ACGT-', 'TGCA-')
-    complemented = allele.translate(complement)
-    logger.debug(f"Complemented allele: {allele} -> {complemented}")
+    complemented = allele.encode('ascii').translate(COMPLEMENT_TABLE).decode('ascii')
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(f"Complemented allele: {allele} -> {complemented}")
     return complemented
 
-def truncate_text(text, max_length=500):
-    """Truncate text to a maximum length with an ellipsis if needed."""
-    if len(text) <= max_length:
-        return text
-    else:
-        return text[:max_length] + '... [truncated]'
-
 # ================================
 # Ensembl REST Client Initialization
 # ================================
@@ -118,25 +231,38 @@ def initialize_client(reqs_per_sec):
 # Error Checking and Retry Mechanism
 # ================================
 
-def fetch_population_frequencies_batch(batch_dbsnp_ids, batch_number, client):
+def fetch_population_frequencies_batch(batch_dbsnp_ids, batch_number, client, cache=None):
     """
     Fetch population frequencies for a batch of dbSNP IDs.
-    Relies on built-in API limitations and retries until a successful response is received.
+    Retries empty responses and errors with capped exponential backoff, up to VARIATION_MAX_ATTEMPTS times;
+    client errors other than 429 are not retried.
 
     Args:
         batch_dbsnp_ids (list): List of rsIDs.
         batch_number (str): Identifier for the batch (e.g., '15').
         client (EnsemblRestClient): The REST client instance.
+        cache (AnnotationCache, optional): Response cache; only uncached rsIDs are requested.
 
     Returns:
-        dict: Aggregated frequency data for the batch.
+        dict: Aggregated frequency data for the batch (only cached entries if the batch failed).
     """
-    payload = {"ids": batch_dbsnp_ids}
-    payload_str = json.dumps(payload)
-    truncated_payload = truncate_text(payload_str)
-    logger.debug(f"Batch {batch_number} payload for Population Frequencies: {truncated_payload}")
+    cached_responses = {}
+    if cache is not None:
+        cached_responses = cache_get_many(cache, 'variation', batch_dbsnp_ids)
+        batch_dbsnp_ids = [dbsnp_id for dbsnp_id in batch_dbsnp_ids if dbsnp_id not in cached_responses]
+        if not batch_dbsnp_ids:
+            logger.debug(f"Batch {batch_number} population frequencies served from cache")
+            return cached_responses
 
-    while True:
+    payload = {"ids": batch_dbsnp_ids}
+    # Serializing a whole batch just for a debug line is skipped unless DEBUG is enabled
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(f"Batch {batch_number} payload for Population Frequencies: {truncate_text(orjson.dumps(payload).decode())}")
+
+    for attempt in range(1, VARIATION_MAX_ATTEMPTS + 1):
+        if attempt > 1:
+            # Back off exponentially, with jitter so retrying workers don't fire in lockstep
+            time.sleep(min(RETRY_BACKOFF_BASE * 2 ** (attempt - 2), RETRY_BACKOFF_CAP) + random.uniform(0, 1))
         try:
             start_time = time.time()
             response = client.perform_rest_action(
@@ -150,23 +276,46 @@ def fetch_population_frequencies_batch(batch_dbsnp_ids, batch_number, client):
             log_api_time("fetch_population_frequencies", duration)
 
             if response is None or response == {}:
-                logger.error(f"Empty response for batch {batch_number}. Retrying...")
+                logger.error(f"Empty response for batch {batch_number} on attempt {attempt}.")
                 continue
 
-            logger.debug(f"Received response for batch {batch_number}: {truncate_text(json.dumps(response), 1000)}")
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(f"Received response for batch {batch_number}: {truncate_text(orjson.dumps(response).decode(), 1000)}")
+            if cache is not None:
+                cache_set_many(cache, 'variation', response.items())
+                response = {**cached_responses, **response}
             return response
 
+        except requests.exceptions.HTTPError as e:
+            status_code = e.response.status_code if e.response is not None else None
+            if status_code is not None and 400 <= status_code < 500 and status_code != 429:
+                # A rejected payload fails the same way every time
+                logger.error(f"Non-retryable HTTP error {status_code} for batch {batch_number}: {e}")
+                break
+            logger.error(f"Exception during API call for batch {batch_number} on attempt {attempt}: {e}")
+            logger.debug(traceback.format_exc())
         except Exception as e:
-            logger.error(f"Exception during API call for batch {batch_number}: {e}")
+            logger.error(f"Exception during API call for batch {batch_number} on attempt {attempt}: {e}")
             logger.debug(traceback.format_exc())
-            continue  # Retry on exception
+
+    failed_batches.append({'batch_number': batch_number, 'attempts': attempt})
+    return cached_responses
 
 # ================================
 # Original Functions (Unchanged)
 # ================================
 
-def fetch_dbsnp_version():
-    """Fetch dbSNP version from NCBI release notes with retry mechanism."""
+def fetch_dbsnp_version(cache=None):
+    """Fetch dbSNP version from NCBI release notes with retry mechanism.
+
+    If an AnnotationCache is given, a version fetched within DBSNP_VERSION_TTL is reused without a request.
+    """
+    if cache is not None:
+        cached = cache_get_many(cache, 'dbsnp', ['version'])
+        if 'version' in cached:
+            logger.info(f"Using cached dbSNP version: {cached['version']}")
+            return cached['version']
+
     release_notes_url = "https://ftp.ncbi.nlm.nih.gov/snp/latest_release/release_notes.txt"
 
     session = requests.Session()
@@ -188,18 +337,32 @@ def fetch_dbsnp_version():
             if line.startswith("dbSNP build"):
                 version = line.split()[2]  # Extract the version number (e.g., '156')
                 logger.info(f"Fetched dbSNP version: {version}")
+                cache_set_many(cache, 'dbsnp', [('version', version)], ttl=DBSNP_VERSION_TTL)
                 return version
         logger.warning("dbSNP version not found in release notes.")
     except requests.exceptions.RequestException as e:
         logger.error(f"Error fetching dbSNP version after retries: {e}")
     return "Unknown"
 
-def fetch_vep_batch(batch_variants, batch_number, client):
-    """Fetch VEP annotations for a batch of variants."""
+# Largest number of variants per VEP request since Ensembl rejected a bigger one with HTTP 413
+# (None until that happens); later batches are split to this size up front
+vep_request_size_limit = None
+vep_request_size_limit_lock = threading.Lock()
+
+def request_vep_annotations(batch_variants, batch_number, client):
+    """POST variants to VEP, halving the request whenever Ensembl rejects it as too large. Raises on failure."""
+    global vep_request_size_limit
+    limit = vep_request_size_limit
+    if limit is not None and len(batch_variants) > limit:
+        vep_responses = []
+        for start in range(0, len(batch_variants), limit):
+            part_number = f"{batch_number}.{start // limit + 1}"
+            vep_responses.extend(request_vep_annotations(batch_variants[start:start + limit], part_number, client))
+        return vep_responses
+
     payload = {"variants": batch_variants}
-    payload_str = json.dumps(payload)
-    truncated_payload = truncate_text(payload_str)
-    logger.debug(f"Batch {batch_number} payload for VEP: {truncated_payload}")
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(f"Batch {batch_number} payload for VEP: {truncate_text(orjson.dumps(payload).decode())}")
     start_time = time.time()
     try:
         vep_responses = client.perform_rest_action(
@@ -209,21 +372,135 @@ def fetch_vep_batch(batch_variants, batch_number, client):
             hdrs={'Content-Type': 'application/json', 'Accept': 'application/json'},
             retries=5
         )
-        duration = time.time() - start_time
-        log_api_time("fetch_vep_annotations", duration)
+    except PayloadTooLargeError:
+        if len(batch_variants) == 1:
+            raise
+        half = len(batch_variants) // 2
+        with vep_request_size_limit_lock:
+            if vep_request_size_limit is None or half < vep_request_size_limit:
+                vep_request_size_limit = half
+        logger.warning(f"VEP batch {batch_number} of {len(batch_variants)} variants was too large; retrying it in halves.")
+        return (request_vep_annotations(batch_variants[:half], f"{batch_number}a", client)
+                + request_vep_annotations(batch_variants[half:], f"{batch_number}b", client))
+    duration = time.time() - start_time
+    log_api_time("fetch_vep_annotations", duration)
+    return list(vep_responses)
+
+def fetch_vep_batch(batch_variants, batch_number, client, cache=None):
+    """Fetch VEP annotations for a batch of variants, requesting only those missing from the cache if one is given.
+
+    Variants VEP returned no annotation for are remembered in the cache too, and are not requested again until they expire.
+    """
+    cached_responses = []
+    if cache is not None:
+        cached = cache_get_many(cache, 'vep', batch_variants)
+        cached_responses = list(cached.values())
+        batch_variants = [variant for variant in batch_variants if variant not in cached]
+        no_hits = cache_get_many(cache, 'vep_nohit', batch_variants)
+        batch_variants = [variant for variant in batch_variants if variant not in no_hits]
+        if not batch_variants:
+            logger.debug(f"Batch {batch_number} VEP annotations served from cache")
+            return cached_responses
+
+    try:
+        vep_responses = request_vep_annotations(batch_variants, batch_number, client)
     except Exception as e:
         logger.error(f"Exception during VEP API call for batch {batch_number}: {e}")
         vep_responses = []
+    if not vep_responses:
+        # Only reported for variants actually requested; cached no-hits legitimately have no response
+        logger.error(f"No response from VEP for batch {batch_number} ({len(batch_variants)} variants).")
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"Variants of VEP batch {batch_number}: {truncate_text(orjson.dumps(batch_variants).decode())}")
+    if cache is not None:
+        # VEP echoes each submitted variant string back as 'input', which is the cache key
+        if vep_responses:
+            cache_set_many(cache, 'vep', [(response['input'], response) for response in vep_responses if response.get('input')])
+            # Submitted variants missing from a successful response have nothing for VEP to annotate
+            answered = {response.get('input') for response in vep_responses}
+            cache_set_many(cache, 'vep_nohit', [(variant, True) for variant in batch_variants if variant not in answered])
+        vep_responses = cached_responses + list(vep_responses)
     return vep_responses
 
+def annotate_vep_batch(batch_variants, batch_number, client, offset, cache=None):
+    """
+    Fetch VEP annotations for a batch of consecutive rows and reduce them to (row index, rsID, gene) tuples.
+
+    Runs in the worker thread, so walking the response JSON stays off the main thread. offset is the row
+    index of the batch's first variant; rows without a response are left out.
+    """
+    vep_responses = fetch_vep_batch(batch_variants, batch_number, client, cache)
+    if not vep_responses:
+        return []
+    # VEP echoes each submitted variant line back as 'input'; map it to its row within this batch
+    batch_rows = {variant: offset + position for position, variant in enumerate(batch_variants)}
+    annotations = []
+    for response in vep_responses:
+        input_str = response.get('input')
+        idx = batch_rows.get(input_str)
+        if idx is None:
+            logger.warning(f"Variant input '{input_str}' not found in batch {batch_number}.")
+            continue  # Should not happen
+
+        # Extract dbSNP ID: the first colocated variant with an rsID
+        colocated_ids = (var.get('id') for var in response.get('colocated_variants', []))
+        dbsnp_id = next((var_id for var_id in colocated_ids if var_id and var_id.startswith('rs')), '.')
+
+        # Extract gene annotation: the first transcript consequence naming a gene
+        gene_symbols = (tx.get('gene_symbol') for tx in response.get('transcript_consequences', []))
+        gene_annotation = next((gene_symbol for gene_symbol in gene_symbols if gene_symbol), "Intergenic")
+
+        annotations.append((idx, dbsnp_id, gene_annotation))
+    return annotations
+
+# ================================
+# Output Writers
+# ================================
+
+def write_output_tsv(output_file, variants, dbsnp_version):
+    """Write the annotated variants frame as a TSV headed by a dbSNP version comment."""
+    num_records = len(variants)
+    # A large buffer lets each chunk reach the disk in a few big writes
+    with open(output_file, 'w', newline='', buffering=1 << 20) as csvfile:
+        # Write dbSNP version as the first line (header comment)
+        csvfile.write(f"# dbSNP version: {dbsnp_version}\n")
+        csvfile.write('\t'.join(OUTPUT_COLUMNS) + '\n')
+
+        # Format rows in large chunks through pandas' C writer instead of one Python call per row
+        for start in range(0, num_records, WRITE_CHUNK_SIZE):
+            chunk = variants.iloc[start:start + WRITE_CHUNK_SIZE]
+            # The TSV keeps frequency and population together as "<frequency> (<population>)"
+            frequency_text = (chunk['Frequency'].astype(str) + ' (' + chunk['Population'].astype(str) + ')').where(
+                chunk['Frequency'].notna(), 'N/A')
+            chunk = chunk[OUTPUT_COLUMNS].assign(Frequency=frequency_text)
+            chunk.to_csv(csvfile, sep='\t', header=False, index=False, na_rep='NA', lineterminator='\n')
+            logger.debug(f"Wrote {min(start + WRITE_CHUNK_SIZE, num_records)} of {num_records} variants to {output_file}")
+
+def write_output_parquet(output_file, variants, dbsnp_version):
+    """Write the annotated variants frame as typed Parquet, recording the dbSNP version in the schema metadata."""
+    num_records = len(variants)
+    schema = OUTPUT_PARQUET_SCHEMA.with_metadata({'dbsnp_version': str(dbsnp_version)})
+    with pq.ParquetWriter(output_file, schema, compression='zstd', use_dictionary=True) as writer:
+        # Each chunk becomes one row group
+        for start in range(0, num_records, WRITE_CHUNK_SIZE):
+            chunk = variants.iloc[start:start + WRITE_CHUNK_SIZE]
+            writer.write_table(pa.Table.from_pandas(chunk[schema.names], schema=schema, preserve_index=False))
+            logger.debug(f"Wrote {min(start + WRITE_CHUNK_SIZE, num_records)} of {num_records} variants to {output_file}")
+
 # ================================
 # Main Processing Function
 # ================================
 
-def process_vcf(input_vcf, output_file, batch_size, max_workers, client, target_populations):
-    """Process the VCF file and annotate each variant using Ensembl VEP and population frequency data."""
+def process_vcf(input_vcf, output_file, batch_size, max_workers, client, target_populations, cache=None):
+    """Process the VCF file and annotate each variant using Ensembl VEP and population frequency data.
+
+    If an AnnotationCache is given, responses stored by earlier runs are reused and new ones are added to it.
+    """
+    # Population names are matched exactly, so a set makes each check O(1)
+    target_populations = frozenset(target_populations)
+
     # Fetch dbSNP version
-    dbsnp_version = fetch_dbsnp_version()
+    dbsnp_version = fetch_dbsnp_version(cache)
     logger.info(f"Using dbSNP version: {dbsnp_version} (Ensembl GRCh37)")
 
     # Read input VCF file using cyvcf2
@@ -233,168 +510,165 @@ def process_vcf(input_vcf, output_file, batch_size, max_workers, client, target_
         logger.critical(f"Failed to read input VCF file '{input_vcf}': {e}")
         sys.exit(1)
 
-    # Collect variants from VCF
-    records = []
-    vep_variants = []
-    record_map = {}
-
-    for idx, record in enumerate(vcf_reader):
-        chrom = record.CHROM
-        pos = record.POS
-        ref = record.REF
-        alt = record.ALT[0]
-
-        # Construct VEP input in VCF format
-        vep_input = f"{chrom} {pos} . {ref} {alt} . . ."
-        vep_variants.append(vep_input)
-        record_map[vep_input] = idx
-        records.append(record)
-
-    num_records = len(records)
-    logger.info(f"Total variants to process: {num_records}")
-
-    # Initialize lists with placeholders
-    all_dbsnp_ids = ['.'] * num_records
-    all_gene_annotations = ['Intergenic'] * num_records
-    alt_alleles = [record.ALT[0] for record in records]
-
-    # Process VEP variants in parallel
-    vep_batches = []
-    for i in range(0, len(vep_variants), batch_size):
-        batch_variants = vep_variants[i:i + batch_size]
-        batch_number = str((i // batch_size) + 1)
-        vep_batches.append((batch_variants, batch_number))
-
-    logger.info(f"Processing {len(vep_batches)} VEP batches in parallel with batch size {batch_size}")
-
+    # Decided once per file: without a FORMAT/DP header line no record can carry a depth
+    has_dp = any(header.info().get('HeaderType') == 'FORMAT' and header.info().get('ID') == 'DP'
+                 for header in vcf_reader.header_iter())
+
+    # Collect the output fields of each variant column by column, so records aren't kept alive
+    chroms = []
+    positions = []
+    refs = []
+    alts = []
+    depths = []
+    all_dbsnp_ids = []
+    all_gene_annotations = []
+
+    # One worker pool serves both the VEP and the variation stage, run as a pipeline: VEP batches
+    # are submitted as soon as they fill up while the VCF is still being read, finished VEP batches
+    # are handled as they arrive (also during parsing), and the rsIDs they reveal are packed into
+    # variation batches submitted right away.
     with ThreadPoolExecutor(max_workers=max_workers) as executor:
-        future_to_batch = {
-            executor.submit(fetch_vep_batch, batch_variants, batch_number, client): (batch_variants, batch_number)
-            for batch_variants, batch_number in vep_batches
-        }
-
-        for future in as_completed(future_to_batch):
+        future_to_batch = {}
+        # Finished VEP futures, queued by the worker threads for the main thread to handle
+        finished_vep_futures = queue.SimpleQueue()
+
+        # Population frequencies are fetched in batches of rsIDs
+        frequencies = {}
+        batch_size_freq = batch_size  # Can adjust separately if needed
+        variation_future_to_batch = {}
+        pending_dbsnp_ids = []
+        # Frequencies depend only on the rsID, so an rsID shared by several rows is fetched once
+        queued_dbsnp_ids = set()
+
+        def submit_vep_batch(batch_variants, offset):
+            # A batch holds consecutive rows, so offset (its first row index) is all that's needed to map it back
+            batch_number = str(len(future_to_batch) + 1)
+            future = executor.submit(annotate_vep_batch, batch_variants, batch_number, client, offset, cache)
+            future_to_batch[future] = (batch_variants, batch_number)
+            future.add_done_callback(finished_vep_futures.put)
+
+        def submit_variation_batch(batch_dbsnp_ids):
+            batch_number = str(len(variation_future_to_batch) + 1)
+            future = executor.submit(fetch_population_frequencies_batch, batch_dbsnp_ids, batch_number, client, cache)
+            variation_future_to_batch[future] = (batch_dbsnp_ids, batch_number)
+
+        def handle_vep_batch(future):
+            nonlocal pending_dbsnp_ids
             batch_variants, batch_number = future_to_batch[future]
             try:
-                vep_responses = future.result()
-                if not vep_responses:
-                    logger.error(f"No response from VEP for batch {batch_number}. Variants: {truncate_text(json.dumps(batch_variants))}")
-                    continue
-                # Process VEP responses
-                for response in vep_responses:
-                    input_str = response.get('input')
-                    idx = record_map.get(input_str)
-                    if idx is None:
-                        logger.warning(f"Variant input '{input_str}' not found in record_map.")
-                        continue  # Should not happen
-
-                    # Extract dbSNP ID
-                    dbsnp_id = None
-                    colocated_variants = response.get('colocated_variants', [])
-                    for var in colocated_variants:
-                        var_id = var.get('id')
-                        if var_id and var_id.startswith('rs'):
-                            dbsnp_id = var_id
-                            break
-                    if not dbsnp_id:
-                        dbsnp_id = '.'
-
+                # The worker has already reduced the responses to (row index, rsID, gene) tuples;
+                # a failed request was logged there, and its rows keep their placeholders
+                annotations = future.result()
+                for idx, dbsnp_id, gene_annotation in annotations:
                     all_dbsnp_ids[idx] = dbsnp_id
-
-                    # Extract gene annotation
-                    gene_annotation = "Intergenic"
-                    transcripts = response.get('transcript_consequences', [])
-                    if transcripts:
-                        for tx in transcripts:
-                            gene_symbol = tx.get('gene_symbol')
-                            if gene_symbol:
-                                gene_annotation = gene_symbol
-                                break
-
                     all_gene_annotations[idx] = gene_annotation
+                    if dbsnp_id != '.' and dbsnp_id not in queued_dbsnp_ids:
+                        queued_dbsnp_ids.add(dbsnp_id)
+                        pending_dbsnp_ids.append(dbsnp_id)
+                        if len(pending_dbsnp_ids) == batch_size_freq:
+                            submit_variation_batch(pending_dbsnp_ids)
+                            pending_dbsnp_ids = []
 
             except Exception as e:
                 logger.error(f"Error processing VEP batch {batch_number}: {e}")
                 logger.debug(traceback.format_exc())
 
-    # Fetch population frequencies in batches
-    frequencies = {}
-    batch_size_freq = batch_size  # Can adjust separately if needed
-
-    # Prepare list of indices for variants with dbSNP IDs
-    dbsnp_indices = [idx for idx, dbsnp_id in enumerate(all_dbsnp_ids) if dbsnp_id != '.']
-    variation_batches = []
-    for i in range(0, len(dbsnp_indices), batch_size_freq):
-        batch_indices = dbsnp_indices[i:i + batch_size_freq]
-        batch_number = str((i // batch_size_freq) + 1)
-        batch_dbsnp_ids = [all_dbsnp_ids[idx] for idx in batch_indices]
-        variation_batches.append((batch_dbsnp_ids, batch_number))
-
-    logger.info(f"Processing {len(variation_batches)} variation batches in parallel with batch size {batch_size_freq}")
-
-    with ThreadPoolExecutor(max_workers=max_workers) as executor:
-        future_to_batch = {
-            executor.submit(fetch_population_frequencies_batch, batch_dbsnp_ids, batch_number, client): (batch_dbsnp_ids, batch_number)
-            for batch_dbsnp_ids, batch_number in variation_batches
-        }
-
-        for future in as_completed(future_to_batch):
-            batch_dbsnp_ids, batch_number = future_to_batch[future]
+        handled_vep_batches = 0
+        batch_variants = []
+        for idx, record in enumerate(vcf_reader):
+            # cyvcf2 returns a new CHROM string per record; interning keeps one copy per chromosome
+            chrom = sys.intern(record.CHROM)
+            pos = record.POS
+            ref = record.REF
+            alt = record.ALT[0]
+
+            chroms.append(chrom)
+            positions.append(pos)
+            refs.append(ref)
+            alts.append(alt)
+            # DP comes back as a (samples, 1) array, or None for records whose FORMAT lacks it;
+            # take the first sample's scalar
+            dp = record.format('DP') if has_dp else None
+            depths.append(dp[0, 0] if dp is not None else None)
+            # Placeholders until the VEP response for this row is handled
+            all_dbsnp_ids.append('.')
+            all_gene_annotations.append('Intergenic')
+
+            # Construct VEP input in VCF format
+            vep_input = f"{chrom} {pos} . {ref} {alt} . . ."
+            batch_variants.append(vep_input)
+            if len(batch_variants) == batch_size:
+                submit_vep_batch(batch_variants, idx + 1 - batch_size)
+                batch_variants = []
+                # Handle whichever VEP batches have finished so far without waiting for the rest
+                while not finished_vep_futures.empty():
+                    handle_vep_batch(finished_vep_futures.get())
+                    handled_vep_batches += 1
+
+        num_records = len(chroms)
+        if batch_variants:
+            submit_vep_batch(batch_variants, num_records - len(batch_variants))
+
+        logger.info(f"Total variants to process: {num_records}")
+        logger.info(f"Processing {len(future_to_batch)} VEP batches in parallel with batch size {batch_size}")
+
+        # Wait for and handle the remaining VEP batches in completion order
+        for _ in range(len(future_to_batch) - handled_vep_batches):
+            handle_vep_batch(finished_vep_futures.get())
+
+        if pending_dbsnp_ids:
+            submit_variation_batch(pending_dbsnp_ids)
+
+        logger.info(f"Processing {len(variation_future_to_batch)} variation batches in parallel with batch size {batch_size_freq}")
+
+        for future in as_completed(variation_future_to_batch):
+            batch_dbsnp_ids, batch_number = variation_future_to_batch[future]
             try:
                 responses = future.result()
                 if not responses:
-                    logger.error(f"No response from variation endpoint for batch {batch_number}. Variants: {truncate_text(json.dumps(batch_dbsnp_ids))}")
+                    logger.error(f"No response from variation endpoint for batch {batch_number} ({len(batch_dbsnp_ids)} rsIDs).")
+                    if logger.isEnabledFor(logging.DEBUG):
+                        logger.debug(f"rsIDs of variation batch {batch_number}: {truncate_text(orjson.dumps(batch_dbsnp_ids).decode())}")
                     continue
                 # Process responses
                 for dbsnp_id in batch_dbsnp_ids:
                     variant_data = responses.get(dbsnp_id, {})
                     if not variant_data or variant_data == "N/A":
-                        frequencies[dbsnp_id] = "N/A"
                         continue
-                    populations = variant_data.get('populations', [])
-                    max_freq = None
-                    max_population = None
-                    for pop in populations:
-                        population_name = pop.get('population')
-                        freq = pop.get('frequency')
-                        if population_name in target_populations and freq is not None:
-                            if max_freq is None or freq > max_freq:
-                                max_freq = freq
-                                max_population = population_name
-                    if max_freq is not None:
-                        frequencies[dbsnp_id] = f"{max_freq} ({max_population})"
-                    else:
-                        frequencies[dbsnp_id] = "N/A"
+                    # Highest (frequency, population) among the target populations; the first one wins ties
+                    population_frequencies = ((pop.get('frequency'), pop.get('population'))
+                                              for pop in variant_data.get('populations', []))
+                    best = max(((freq, population_name) for freq, population_name in population_frequencies
+                                if population_name in target_populations and freq is not None),
+                               key=itemgetter(0), default=None)
+                    if best is not None:
+                        frequencies[dbsnp_id] = best
 
             except Exception as e:
                 logger.error(f"Error processing variation batch {batch_number}: {e}")
                 logger.debug(traceback.format_exc())
 
-    # Write results to output file
+    # Assemble the per-variant columns into one frame (row number = VCF record order) and join
+    # each rsID's highest target-population frequency onto it
+    variants = pd.DataFrame({
+        'CHROM': chroms,
+        'POS': positions,
+        'ID': all_dbsnp_ids,
+        'REF': refs,
+        'ALT': alts,
+        'Gene': all_gene_annotations,
+        # object dtype keeps integer depths from being widened to float around missing values
+        'DP': pd.Series(depths, dtype=object)
+    })
+    frequency_table = pd.DataFrame.from_dict(frequencies, orient='index', columns=['Frequency', 'Population'])
+    variants = variants.join(frequency_table.astype({'Frequency': float, 'Population': object}), on='ID')
+
+    # Write results to output file, as Parquet or TSV depending on its extension
     try:
-        with open(output_file, 'w', newline='') as csvfile:
-            # Write dbSNP version as the first line (header comment)
-            csvfile.write(f"# dbSNP version: {dbsnp_version}\n")
-            fieldnames = ['CHROM', 'POS', 'ID', 'REF', 'ALT', 'Gene', 'Frequency', 'DP']
-            writer = csv.DictWriter(csvfile, fieldnames=fieldnames, delimiter='\t')
-            writer.writeheader()
-
-            for idx, record in enumerate(records):
-                dbsnp_id = all_dbsnp_ids[idx]
-                gene_annotation = all_gene_annotations[idx]
-                alt_allele = record.ALT[0]
-                frequency = frequencies.get(dbsnp_id, "N/A") if dbsnp_id != '.' else "N/A"
-
-                writer.writerow({
-                    'CHROM': record.CHROM,
-                    'POS': record.POS,
-                    'ID': dbsnp_id,
-                    'REF': record.REF,
-                    'ALT': alt_allele,
-                    'Gene': gene_annotation,
-                    'Frequency': frequency,
-                    'DP': record.format('DP')[0] if 'DP' in record.FORMAT else 'NA'
-                })
+        if output_file.endswith('.parquet'):
+            write_output_parquet(output_file, variants, dbsnp_version)
+        else:
+            write_output_tsv(output_file, variants, dbsnp_version)
     except Exception as e:
         logger.critical(f"Failed to write to output file '{output_file}': {e}")
         sys.exit(1)
@@ -418,23 +692,36 @@ def process_vcf(input_vcf, output_file, batch_size, max_workers, client, target_
 
 def main():
     args = parse_arguments()
+    max_workers = args.max_workers
+    if max_workers is None:
+        # Workers beyond about two per allowed request/s would only queue on the rate limiter
+        max_workers = min(32, 2 * args.reqs_per_sec)
     client = initialize_client(args.reqs_per_sec)
+    cache = None
+    if args.cache_dir and not args.no_cache:
+        try:
+            os.makedirs(args.cache_dir, exist_ok=True)
+            cache = AnnotationCache(os.path.join(args.cache_dir, CACHE_FILE_NAME), refresh=args.refresh_cache)
+        except (OSError, sqlite3.Error) as e:
+            # The cache only saves requests; a read-only or missing cache directory shouldn't stop the run
+            logger.warning(f"Response cache in '{args.cache_dir}' is unavailable, continuing without it: {e}")
     try:
         process_vcf(
             input_vcf=args.input_vcf,
             output_file=args.output_tsv,
             batch_size=args.batch_size,
-            max_workers=args.max_workers,
+            max_workers=max_workers,
             client=client,
-            target_populations=args.target_populations
+            target_populations=args.target_populations,
+            cache=cache
         )
     except Exception as e:
         logger.critical(f"An unexpected error occurred: {e}")
         logger.debug(traceback.format_exc())
         sys.exit(1)
+    finally:
+        if cache is not None:
+            cache.close()
 
 if __name__ == "__main__":
-    if len(sys.argv) < 3:
-        logger.error("Usage: python annotate_variants_ensembl.py <input_vcf> <output_tsv> [--batch_size N] [--max_workers M] [--reqs_per_sec R]")
-        sys.exit(1)
     main()
@@ -0,0 +1,64 @@
+import orjson
+import logging
+import sqlite3
+import threading
+import time
+
+# Cached responses older than this many seconds are treated as missing and fetched again
+DEFAULT_TTL = 30 * 24 * 60 * 60
+
+# Maximum number of keys bound into a single SELECT (SQLite's default variable limit is 999)
+_QUERY_CHUNK_SIZE = 500
+
+class AnnotationCache(object):
+    """On-disk SQLite cache of Ensembl API responses, keyed by namespace (e.g. 'vep') and variant key."""
+
+    def __init__(self, path, ttl=DEFAULT_TTL, refresh=False):
+        self.path = path
+        self.ttl = ttl
+        # In refresh mode lookups miss, so every response is fetched again and overwrites its cached entry
+        self.refresh = refresh
+        # One connection shared by the worker threads; the lock serializes access to it
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "namespace TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL, expires REAL NOT NULL, "
+                "PRIMARY KEY (namespace, key))"
+            )
+
+    def get_many(self, namespace, keys):
+        """Return {key: response} for the keys with an unexpired cached response (none in refresh mode)."""
+        if self.refresh:
+            return {}
+        keys = list(dict.fromkeys(keys))
+        now = time.time()
+        found = {}
+        with self._lock:
+            for start in range(0, len(keys), _QUERY_CHUNK_SIZE):
+                chunk = keys[start:start + _QUERY_CHUNK_SIZE]
+                placeholders = ','.join('?' * len(chunk))
+                rows = self._conn.execute(
+                    f"SELECT key, value FROM responses WHERE namespace = ? AND expires > ? AND key IN ({placeholders})",
+                    [namespace, now, *chunk]
+                ).fetchall()
+                for key, value in rows:
+                    found[key] = orjson.loads(value)
+        logging.debug(f"Annotation cache '{namespace}': {len(found)} of {len(keys)} keys found")
+        return found
+
+    def set_many(self, namespace, items, ttl=None):
+        """Store (key, response) pairs, replacing any existing entries; ttl overrides the cache's default."""
+        expires = time.time() + (self.ttl if ttl is None else ttl)
+        rows = [(namespace, key, orjson.dumps(value).decode('utf-8'), expires) for key, value in items]
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO responses (namespace, key, value, expires) VALUES (?, ?, ?, ?)",
+                rows
+            )
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -1,13 +1,24 @@
 import threading
+import collections
 import time
 import sys
-import json
+import orjson
 import logging
 import traceback
-from urllib.parse import urlencode
-from urllib.request import urlopen, Request
-from urllib.error import HTTPError, URLError
 import random
+import requests
+from requests.adapters import HTTPAdapter
+
+# Seconds to wait for the server to accept a connection and to send response data
+REQUEST_TIMEOUT = 60
+
+# One HTTP session shared by every client and worker thread, so keep-alive connections to the
+# Ensembl host are reused across batches instead of paying a new TCP handshake per request.
+# Retries stay in perform_rest_action, which knows how to honour Retry-After.
+SESSION = requests.Session()
+_adapter = HTTPAdapter(pool_connections=32, pool_maxsize=32)
+SESSION.mount('http://', _adapter)
+SESSION.mount('https://', _adapter)
 
 def truncate_text(text, max_length=500):
     """Truncate text to a maximum length with an ellipsis if needed."""
@@ -16,35 +27,33 @@ def truncate_text(text, max_length=500):
     else:
         return text[:max_length] + '... [truncated]'
 
+class PayloadTooLargeError(requests.exceptions.HTTPError):
+    """Raised when Ensembl rejects a request body as too large (HTTP 413); retrying the same body won't help."""
+
 class EnsemblRestClient(object):
+    # Start times (time.monotonic) of the requests made in the last second, shared by all clients and threads
     _global_lock = threading.Lock()
-    _req_count = 0
-    _last_reset = time.time()
+    _request_times = collections.deque()
 
     def __init__(self, server='http://grch37.rest.ensembl.org', reqs_per_sec=15):
         self.server = server
         self.reqs_per_sec = reqs_per_sec
 
     def _check_rate_limit(self):
-        with EnsemblRestClient._global_lock:
-            current_time = time.time()
-            elapsed = current_time - EnsemblRestClient._last_reset
-            if elapsed >= 1:
-                # Reset every second
-                EnsemblRestClient._req_count = 0
-                EnsemblRestClient._last_reset = current_time
-            if EnsemblRestClient._req_count < self.reqs_per_sec:
-                EnsemblRestClient._req_count += 1
-                return
-            else:
-                # Sleep until the next second starts
-                sleep_time = 1 - elapsed
-                if sleep_time > 0:
-                    logging.debug(f"Rate limit reached. Sleeping for {sleep_time:.2f} seconds.")
-                    time.sleep(sleep_time)
-                # Reset count after sleeping
-                EnsemblRestClient._req_count = 1
-                EnsemblRestClient._last_reset = time.time()
+        # Sliding one-second window: a caller may proceed once fewer than reqs_per_sec requests
+        # started in the last second, otherwise it sleeps (outside the lock) until the oldest one ages out
+        while True:
+            with EnsemblRestClient._global_lock:
+                current_time = time.monotonic()
+                request_times = EnsemblRestClient._request_times
+                while request_times and current_time - request_times[0] >= 1:
+                    request_times.popleft()
+                if len(request_times) < self.reqs_per_sec:
+                    request_times.append(current_time)
+                    return
+                sleep_time = 1 - (current_time - request_times[0])
+            logging.debug(f"Rate limit reached. Sleeping for {sleep_time:.2f} seconds.")
+            time.sleep(sleep_time)
 
     def perform_rest_action(self, endpoint, method='GET', hdrs=None, params=None, data=None, retries=5):
         if hdrs is None:
@@ -55,12 +64,10 @@ class EnsemblRestClient(object):
         if 'Accept' not in hdrs:
             hdrs['Accept'] = 'application/json'
 
-        if params:
-            endpoint += '?' + urlencode(params)
-
         if data is not None and method == 'POST':
             if isinstance(data, dict):
-                data = json.dumps(data).encode('utf-8')
+                # orjson serializes the large id/variant lists several times faster than json
+                data = orjson.dumps(data)
             elif isinstance(data, str):
                 data = data.encode('utf-8')
 
@@ -71,29 +78,31 @@ class EnsemblRestClient(object):
             self._check_rate_limit()
 
             try:
-                request = Request(self.server + endpoint, data=data, headers=hdrs, method=method)
-                with urlopen(request) as response:
-                    status_code = response.getcode()
-                    headers = response.headers
-                    content = response.read()
-                    if content:
-                        result_data = json.loads(content)
-                    else:
-                        result_data = {}
-                    logging.debug(f"Successful API call to {endpoint} on attempt {attempt}: Status {status_code}, Headers {dict(headers)}")
-                    return result_data  # Success
-            except HTTPError as e:
+                response = SESSION.request(method, self.server + endpoint, params=params, data=data,
+                                           headers=hdrs, timeout=REQUEST_TIMEOUT)
+                response.raise_for_status()
+                content = response.content
+                if content:
+                    result_data = orjson.loads(content)
+                else:
+                    result_data = {}
+                logging.debug(f"Successful API call to {endpoint} on attempt {attempt}: Status {response.status_code}, Headers {dict(response.headers)}")
+                return result_data  # Success
+            except requests.exceptions.HTTPError as e:
+                status_code = e.response.status_code
+                reason = e.response.reason
+                headers = e.response.headers
                 error_content = None
                 try:
-                    error_content = e.read().decode('utf-8', errors='replace')
+                    error_content = e.response.text
                 except Exception as read_error:
                     logging.error(f"Error reading error content: {read_error}")
                 truncated_error_content = truncate_text(error_content) if error_content else "No error content received."
-                logging.error(f"HTTPError for endpoint {endpoint} on attempt {attempt}: Status code: {e.code} Reason: {e.reason}")
+                logging.error(f"HTTPError for endpoint {endpoint} on attempt {attempt}: Status code: {status_code} Reason: {reason}")
                 logging.error(f"Error content for endpoint {endpoint} on attempt {attempt}: {truncated_error_content}")
 
-                if e.code == 429:
-                    retry_after = e.headers.get('Retry-After') if e.headers else None
+                if status_code == 429:
+                    retry_after = headers.get('Retry-After') if headers else None
                     if retry_after:
                         try:
                             sleep_duration = float(retry_after)
@@ -107,8 +116,8 @@ class EnsemblRestClient(object):
                     time.sleep(sleep_duration)
                     last_exception = e
                     continue  # Retry the request
-                elif e.code in [500, 502, 503, 504]:
-                    retry_after = e.headers.get('Retry-After') if e.headers else None
+                elif status_code in [500, 502, 503, 504]:
+                    retry_after = headers.get('Retry-After') if headers else None
                     if retry_after:
                         try:
                             sleep_duration = float(retry_after)
@@ -118,20 +127,20 @@ class EnsemblRestClient(object):
                         sleep_duration = 2 ** attempt
                     # Introduce jitter
                     sleep_duration += random.uniform(0, 1)
-                    logging.warning(f"HTTP {e.code} {e.reason} for endpoint {endpoint}. Retrying after {sleep_duration:.2f} seconds.")
+                    logging.warning(f"HTTP {status_code} {reason} for endpoint {endpoint}. Retrying after {sleep_duration:.2f} seconds.")
                     time.sleep(sleep_duration)
                     last_exception = e
                     continue
-                elif e.code == 413:
+                elif status_code == 413:
                     # Payload Too Large
                     logging.error(f"Payload too large for endpoint {endpoint}. Consider reducing batch size.")
-                    return {}
+                    raise PayloadTooLargeError(f"Payload too large for endpoint {endpoint}", response=e.response) from e
                 else:
                     # Non-retryable error
-                    logging.error(f"Non-retryable HTTP error {e.code} for endpoint {endpoint}.")
+                    logging.error(f"Non-retryable HTTP error {status_code} for endpoint {endpoint}.")
                     raise e  # Re-raise the exception for non-retryable errors
-            except URLError as e:
-                logging.error(f"URLError for endpoint {endpoint} on attempt {attempt}: {e.reason}")
+            except requests.exceptions.RequestException as e:
+                logging.error(f"Request error for endpoint {endpoint} on attempt {attempt}: {e}")
                 logging.debug(traceback.format_exc())
                 if attempt < retries:
                     sleep_duration = 2 ** attempt + random.uniform(0, 1)
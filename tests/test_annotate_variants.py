@@ -1,11 +1,22 @@
+import os
+import sqlite3
+import tempfile
 import unittest
 from unittest.mock import patch, MagicMock
 import argparse
+import requests
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 from annotate_variants_ensembl import (
     is_valid_rsid, normalize_alleles, complement_allele, truncate_text,
-    fetch_population_frequencies_batch, fetch_vep_batch, process_vcf, main
+    fetch_population_frequencies_batch, fetch_vep_batch, annotate_vep_batch, fetch_dbsnp_version, process_vcf, main,
+    parse_arguments, write_output_parquet, log_api_time, close_api_time_logs, failed_batches, OUTPUT_PARQUET_SCHEMA
 )
-from ensembl_client import EnsemblRestClient
+from ensembl_client import EnsemblRestClient, PayloadTooLargeError
+from annotation_cache import AnnotationCache
+from app import load_variants
 
 class TestAnnotateVariants(unittest.TestCase):
 
@@ -13,6 +24,11 @@ class TestAnnotateVariants(unittest.TestCase):
         # Setup common mock client
         self.mock_client = MagicMock(spec=EnsemblRestClient)
 
+        # API timings would otherwise be appended to logs/ in the working directory, by every xdist worker
+        log_api_time_patcher = patch('annotate_variants_ensembl.log_api_time')
+        log_api_time_patcher.start()
+        self.addCleanup(log_api_time_patcher.stop)
+
     # ------------------------------
     # Helper Functions Tests
     # ------------------------------
@@ -42,6 +58,22 @@ class TestAnnotateVariants(unittest.TestCase):
         not_truncated = truncate_text('Short string', 20)
         self.assertEqual(not_truncated, 'Short string')
 
+    @patch('annotate_variants_ensembl.API_TIME_LOG_FLUSH_EVERY', 2)
+    def test_log_api_time_flushes_periodically(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            log_path = os.path.join(tmp_dir, 'api_times_log.tsv')
+            self.addCleanup(close_api_time_logs)
+
+            log_api_time('fetch_vep_annotations', 0.5, log_path)
+            with open(log_path) as log_file:
+                self.assertEqual(log_file.read(), '')
+
+            # Entries reach the disk in groups, without waiting for the run to end
+            log_api_time('fetch_vep_annotations', 0.25, log_path)
+            with open(log_path) as log_file:
+                self.assertEqual(log_file.read().splitlines(), ['fetch_vep_annotations\t0.5000', 'fetch_vep_annotations\t0.2500'])
+            close_api_time_logs()
+
     # ------------------------------
     # API Interaction Tests
     # ------------------------------
@@ -59,6 +91,26 @@ class TestAnnotateVariants(unittest.TestCase):
         result = fetch_population_frequencies_batch(['rs123'], '1', self.mock_client)
         self.assertEqual(result['rs123']['populations'][0]['population'], '1000GENOMES:CEU')
 
+    @patch('annotate_variants_ensembl.time.sleep')
+    def test_fetch_population_frequencies_batch_gives_up(self, mock_sleep):
+        # Empty responses are retried with backoff until the attempts run out
+        self.mock_client.perform_rest_action.return_value = {}
+        result = fetch_population_frequencies_batch(['rs123'], 'empty', self.mock_client)
+        self.assertEqual(result, {})
+        self.assertEqual(self.mock_client.perform_rest_action.call_count, 5)
+        self.assertEqual(mock_sleep.call_count, 4)
+        self.assertIn({'batch_number': 'empty', 'attempts': 5}, failed_batches)
+
+        # A client error is not retried
+        self.mock_client.perform_rest_action.reset_mock(return_value=True)
+        bad_request = requests.Response()
+        bad_request.status_code = 400
+        self.mock_client.perform_rest_action.side_effect = requests.exceptions.HTTPError(response=bad_request)
+        result = fetch_population_frequencies_batch(['rs123'], 'rejected', self.mock_client)
+        self.assertEqual(result, {})
+        self.assertEqual(self.mock_client.perform_rest_action.call_count, 1)
+        self.assertIn({'batch_number': 'rejected', 'attempts': 1}, failed_batches)
+
     def test_fetch_vep_batch(self):
         # Set up the mock return value
         self.mock_client.perform_rest_action.return_value = [{
@@ -71,6 +123,98 @@ class TestAnnotateVariants(unittest.TestCase):
         self.assertEqual(result[0]['colocated_variants'][0]['id'], 'rs12345')
         self.assertEqual(result[0]['transcript_consequences'][0]['gene_symbol'], 'BRCA1')
 
+    def test_annotate_vep_batch(self):
+        self.mock_client.perform_rest_action.return_value = [
+            {'input': '1 2000 . G C . . .', 'colocated_variants': [{'id': 'COSV1'}, {'id': 'rs99'}],
+             'transcript_consequences': [{'impact': 'MODIFIER'}, {'gene_symbol': 'TP53'}]},
+            {'input': '1 1000 . A T . . .'}
+        ]
+
+        # Rows are numbered from the batch offset, whatever order the responses come in
+        result = annotate_vep_batch(['1 1000 . A T . . .', '1 2000 . G C . . .'], '1', self.mock_client, 10)
+        self.assertEqual(result, [(11, 'rs99', 'TP53'), (10, '.', 'Intergenic')])
+
+    @patch('annotate_variants_ensembl.vep_request_size_limit', None)
+    def test_fetch_vep_batch_splits_oversized_requests(self):
+        variants = ['1 1000 . A T . . .', '1 2000 . G C . . .', '1 3000 . T G . . .', '1 4000 . C A . . .']
+
+        def perform_rest_action(endpoint, data, **kwargs):
+            # Reject anything larger than two variants
+            if len(data['variants']) > 2:
+                raise PayloadTooLargeError('Payload too large')
+            return [{'input': variant} for variant in data['variants']]
+        self.mock_client.perform_rest_action.side_effect = perform_rest_action
+
+        result = fetch_vep_batch(variants, '1', self.mock_client)
+        self.assertEqual([response['input'] for response in result], variants)
+
+        # The size that worked is used up front for later batches
+        self.mock_client.perform_rest_action.reset_mock()
+        fetch_vep_batch(variants, '2', self.mock_client)
+        self.assertEqual(self.mock_client.perform_rest_action.call_count, 2)
+
+    def test_fetch_vep_batch_uses_cache(self):
+        self.mock_client.perform_rest_action.return_value = [{
+            'input': '1 1000 . A T . . .',
+            'colocated_variants': [{'id': 'rs12345'}]
+        }]
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            cache = AnnotationCache(os.path.join(tmp_dir, 'cache.sqlite'))
+            self.addCleanup(cache.close)
+
+            fetch_vep_batch(['1 1000 . A T . . .'], '1', self.mock_client, cache)
+            # A repeated variant is answered from the cache; only the new one is requested
+            self.mock_client.perform_rest_action.return_value = [{'input': '1 2000 . G C . . .'}]
+            result = fetch_vep_batch(['1 1000 . A T . . .', '1 2000 . G C . . .'], '2', self.mock_client, cache)
+
+            sent_variants = self.mock_client.perform_rest_action.call_args.kwargs['data']['variants']
+            self.assertEqual(sent_variants, ['1 2000 . G C . . .'])
+            self.assertCountEqual([response['input'] for response in result], ['1 1000 . A T . . .', '1 2000 . G C . . .'])
+
+            # A variant VEP had no annotation for is not requested again
+            self.mock_client.perform_rest_action.return_value = [{'input': '1 3000 . T G . . .'}]
+            fetch_vep_batch(['1 3000 . T G . . .', '1 4000 . C A . . .'], '3', self.mock_client, cache)
+            self.mock_client.perform_rest_action.reset_mock()
+            with self.assertNoLogs(level='ERROR'):
+                result = fetch_vep_batch(['1 4000 . C A . . .'], '4', self.mock_client, cache)
+            self.mock_client.perform_rest_action.assert_not_called()
+            self.assertEqual(result, [])
+
+    def test_locked_cache_keeps_fetched_responses(self):
+        # Another job holding the cache file must not cost the responses already fetched
+        locked_cache = MagicMock(spec=AnnotationCache)
+        locked_cache.get_many.side_effect = sqlite3.OperationalError('database is locked')
+        locked_cache.set_many.side_effect = sqlite3.OperationalError('database is locked')
+
+        self.mock_client.perform_rest_action.return_value = [{
+            'input': '1 1000 . A T . . .',
+            'colocated_variants': [{'id': 'rs12345'}],
+            'transcript_consequences': [{'gene_symbol': 'BRCA1'}]
+        }]
+        result = annotate_vep_batch(['1 1000 . A T . . .'], '1', self.mock_client, 0, locked_cache)
+        self.assertEqual(result, [(0, 'rs12345', 'BRCA1')])
+
+        # The variation batch is requested once, not retried because the cache write failed
+        self.mock_client.perform_rest_action.reset_mock(return_value=True)
+        self.mock_client.perform_rest_action.return_value = {'rs12345': {'populations': []}}
+        result = fetch_population_frequencies_batch(['rs12345'], '1', self.mock_client, locked_cache)
+        self.assertEqual(result, {'rs12345': {'populations': []}})
+        self.assertEqual(self.mock_client.perform_rest_action.call_count, 1)
+
+    @patch('annotate_variants_ensembl.requests.Session')
+    def test_fetch_dbsnp_version_uses_cache(self, mock_session):
+        mock_session.return_value.get.return_value.text = "dbSNP build 156 release notes\n"
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            cache = AnnotationCache(os.path.join(tmp_dir, 'cache.sqlite'))
+            self.addCleanup(cache.close)
+
+            self.assertEqual(fetch_dbsnp_version(cache), '156')
+            # The second lookup is answered from the cache without contacting NCBI
+            self.assertEqual(fetch_dbsnp_version(cache), '156')
+            self.assertEqual(mock_session.return_value.get.call_count, 1)
+
     # ------------------------------
     # VCF Processing Tests
     # ------------------------------
@@ -78,20 +222,73 @@ class TestAnnotateVariants(unittest.TestCase):
     @patch('annotate_variants_ensembl.VCF')  # Corrected Patch Target
     @patch('annotate_variants_ensembl.fetch_vep_batch')
     @patch('annotate_variants_ensembl.fetch_population_frequencies_batch')
-    def test_process_vcf(self, mock_population_frequencies, mock_vep, mock_vcf):
-        # Mock the VCF records
-        mock_vcf.return_value = [MagicMock(CHROM='1', POS=1000, REF='A', ALT=['T'], FORMAT={'DP': [10]})]
+    @patch('annotate_variants_ensembl.fetch_dbsnp_version', return_value='156')
+    def test_process_vcf(self, mock_dbsnp_version, mock_population_frequencies, mock_vep, mock_vcf):
+        # Mock the VCF records; cyvcf2 returns FORMAT fields as a (samples, values) array
+        mock_record = MagicMock(CHROM='1', POS=1000, REF='A', ALT=['T'])
+        mock_record.format.return_value = np.array([[10]], dtype=np.int32)
+        mock_vcf.return_value.__iter__.return_value = [mock_record]
+        mock_vcf.return_value.header_iter.return_value = [MagicMock(**{'info.return_value': {'HeaderType': 'FORMAT', 'ID': 'DP'}})]
         
         # Mock the VEP and population responses
         mock_vep.return_value = [{'input': '1 1000 . A T . . .', 'colocated_variants': [{'id': 'rs12345'}]}]
         mock_population_frequencies.return_value = {'rs12345': {'populations': [{'population': '1000GENOMES:CEU', 'frequency': 0.1}]}}
 
-        process_vcf('test.vcf', 'output.tsv', 25, 5, self.mock_client, ['1000GENOMES:CEU'])
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            output_path = os.path.join(tmp_dir, 'output.tsv')
+            process_vcf('test.vcf', output_path, 25, 5, self.mock_client, ['1000GENOMES:CEU'])
+
+            output = pd.read_csv(output_path, sep='\t', comment='#', dtype=str, keep_default_na=False)
+            self.assertEqual(output['ID'].tolist(), ['rs12345'])
+            self.assertEqual(output['DP'].tolist(), ['10'])
+            with open(output_path) as f:
+                self.assertEqual(f.readline(), '# dbSNP version: 156\n')
+
+            # Without a FORMAT/DP header the depth is written as missing
+            mock_vcf.return_value.header_iter.return_value = [MagicMock(**{'info.return_value': {'HeaderType': 'INFO', 'ID': 'DP'}})]
+            process_vcf('test.vcf', output_path, 25, 5, self.mock_client, ['1000GENOMES:CEU'])
+
+            output = pd.read_csv(output_path, sep='\t', comment='#', dtype=str, keep_default_na=False)
+            self.assertEqual(output['DP'].tolist(), ['NA'])
 
-        # Check if the output file is written
-        with open('output.tsv', 'r') as f:
-            content = f.readlines()
-            self.assertTrue(any('rs12345' in line for line in content))
+    def test_write_output_parquet_round_trip(self):
+        variants = pd.DataFrame({
+            'CHROM': ['1', '2'],
+            'POS': [1000, 2000],
+            'ID': ['rs12345', '.'],
+            'REF': ['A', 'G'],
+            'ALT': ['T', 'C'],
+            'Gene': ['BRCA1', 'Intergenic'],
+            'DP': pd.Series([10, None], dtype=object),
+            'Frequency': [0.1, float('nan')],
+            'Population': ['gnomADe:NFE', None]
+        })
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            parts = [os.path.join(tmp_dir, f'part{number}.annotated.parquet') for number in (1, 2)]
+            for part in parts:
+                write_output_parquet(part, variants, '156')
+
+            schema = pq.read_schema(parts[0])
+            self.assertTrue(schema.equals(OUTPUT_PARQUET_SCHEMA))
+            self.assertEqual(schema.metadata[b'dbsnp_version'], b'156')
+
+            # Concatenated the way the Snakefile's concatenate rule does it
+            merged_path = os.path.join(tmp_dir, 'annotated_variants.parquet')
+            pq.write_table(pa.concat_tables([pq.read_table(part) for part in parts]), merged_path,
+                           compression="zstd", use_dictionary=True)
+            self.assertEqual(pq.read_schema(merged_path).metadata[b'dbsnp_version'], b'156')
+
+            df = load_variants(merged_path)
+            self.assertEqual(len(df), 4)
+            self.assertListEqual(df['ID'].tolist(), ['rs12345', '.', 'rs12345', '.'])
+            self.assertEqual(df['Frequency'].dtype, 'Float32')
+            self.assertAlmostEqual(df['Frequency'].iloc[0], 0.1, places=6)
+            self.assertTrue(pd.isna(df['Frequency'].iloc[1]))
+            self.assertListEqual(df['Population'].tolist(), ['gnomADe:NFE', 'N/A', 'gnomADe:NFE', 'N/A'])
+            self.assertEqual(df['DP'].dtype, 'Int32')
+            self.assertEqual(df['DP'].iloc[0], 10)
+            self.assertTrue(pd.isna(df['DP'].iloc[1]))
 
     # ------------------------------
     # Main Function Tests
@@ -101,11 +298,33 @@ class TestAnnotateVariants(unittest.TestCase):
     @patch('annotate_variants_ensembl.process_vcf')
     def test_main(self, mock_process_vcf, mock_parse_arguments):
         mock_parse_arguments.return_value = argparse.Namespace(
-            input_vcf='test.vcf', output_tsv='output.tsv', batch_size=25, max_workers=15, reqs_per_sec=10, target_populations=['1000GENOMES:CEU'])
+            input_vcf='test.vcf', output_tsv='output.tsv', batch_size=25, max_workers=15, reqs_per_sec=10,
+            cache_dir=None, no_cache=True, refresh_cache=False, target_populations=['1000GENOMES:CEU'])
         
         main()
         mock_process_vcf.assert_called_once()
 
+    def test_parse_arguments_rejects_non_positive_workers(self):
+        with patch('sys.argv', ['annotate_variants_ensembl.py', 'in.vcf', 'out.tsv', '--max_workers', '0']), \
+                patch('sys.stderr'):
+            with self.assertRaises(SystemExit):
+                parse_arguments()
+
+        with patch('sys.argv', ['annotate_variants_ensembl.py', 'in.vcf', 'out.tsv']):
+            self.assertIsNone(parse_arguments().max_workers)
+
+    @patch('annotate_variants_ensembl.parse_arguments')
+    @patch('annotate_variants_ensembl.process_vcf')
+    def test_main_runs_without_unwritable_cache(self, mock_process_vcf, mock_parse_arguments):
+        mock_parse_arguments.return_value = argparse.Namespace(
+            input_vcf='test.vcf', output_tsv='output.tsv', batch_size=25, max_workers=15, reqs_per_sec=10,
+            cache_dir='/read-only/varannotator', no_cache=False, refresh_cache=False,
+            target_populations=['1000GENOMES:CEU'])
+
+        with patch('annotate_variants_ensembl.os.makedirs', side_effect=PermissionError('Read-only file system')):
+            main()
+        self.assertIsNone(mock_process_vcf.call_args.kwargs['cache'])
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,61 @@
+# test_annotation_cache.py
+
+import os
+import tempfile
+import unittest
+from unittest.mock import patch
+from annotation_cache import AnnotationCache
+
+class TestAnnotationCache(unittest.TestCase):
+
+    def setUp(self):
+        # Create a cache in a fresh temporary directory
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+        self.cache_path = os.path.join(self.tmp_dir.name, 'cache.sqlite')
+        self.cache = AnnotationCache(self.cache_path)
+        self.addCleanup(self.cache.close)
+
+    def test_get_many_returns_stored_responses(self):
+        self.cache.set_many('variation', [('rs1', {'populations': []}), ('rs2', {'mappings': [1, 2]})])
+
+        found = self.cache.get_many('variation', ['rs1', 'rs2', 'rs3'])
+        self.assertEqual(found, {'rs1': {'populations': []}, 'rs2': {'mappings': [1, 2]}})
+
+        # Namespaces are kept apart
+        self.assertEqual(self.cache.get_many('vep', ['rs1']), {})
+
+    def test_responses_persist_across_instances(self):
+        self.cache.set_many('vep', [('1 100 . A T . . .', {'input': '1 100 . A T . . .'})])
+
+        reopened = AnnotationCache(self.cache_path)
+        self.addCleanup(reopened.close)
+        self.assertIn('1 100 . A T . . .', reopened.get_many('vep', ['1 100 . A T . . .']))
+
+    def test_expired_responses_are_ignored(self):
+        cache = AnnotationCache(self.cache_path, ttl=60)
+        self.addCleanup(cache.close)
+        with patch('annotation_cache.time.time', return_value=1000.0):
+            cache.set_many('variation', [('rs1', {})])
+        with patch('annotation_cache.time.time', return_value=1061.0):
+            self.assertEqual(cache.get_many('variation', ['rs1']), {})
+
+    def test_set_many_ttl_overrides_default(self):
+        with patch('annotation_cache.time.time', return_value=1000.0):
+            self.cache.set_many('dbsnp', [('version', '156')], ttl=60)
+        with patch('annotation_cache.time.time', return_value=1061.0):
+            self.assertEqual(self.cache.get_many('dbsnp', ['version']), {})
+
+    def test_refresh_mode_skips_lookups_but_stores(self):
+        self.cache.set_many('vep', [('1 100 . A T . . .', {'input': 'old'})])
+
+        refreshing = AnnotationCache(self.cache_path, refresh=True)
+        self.addCleanup(refreshing.close)
+        self.assertEqual(refreshing.get_many('vep', ['1 100 . A T . . .']), {})
+        refreshing.set_many('vep', [('1 100 . A T . . .', {'input': 'new'})])
+
+        # The refreshed response replaces the old one for later runs
+        self.assertEqual(self.cache.get_many('vep', ['1 100 . A T . . .']), {'1 100 . A T . . .': {'input': 'new'}})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,15 +1,53 @@
 # test_app.py
 
+import os
+import tempfile
 import unittest
-from unittest.mock import patch
+from unittest.mock import patch, mock_open
 import pandas as pd
-from app import app, load_variants, validate_query_param
+import app as app_module
+from app import app, load_variants, validate_query_param, get_variants_df
 
 class TestApp(unittest.TestCase):
 
-    def setUp(self):
+    _completed_status = '{"status": "completed", "message": "Pipeline completed."}'
+
+    @classmethod
+    def setUpClass(cls):
+        # Frames shared by the endpoint tests; the app only reads them, so one copy per class is enough
+        cls._df_one_row = pd.DataFrame({
+            'ID': ['rs1'],
+            'Gene': ['GENE1'],
+            'Frequency': [0.1],
+            'DP': [10]
+        })
+        cls._df_two_rows = pd.DataFrame({
+            'ID': ['rs1', 'rs2'],
+            'Gene': ['GENE1', 'GENE2'],
+            'Frequency': [0.1, 0.2],
+            'Population': ['EUR', 'AFR'],
+            'DP': [10, 20]
+        })
+        cls._empty_df = pd.DataFrame()
+        # mock_open rewinds its read data on every open(), so one instance serves every test
+        cls._mock_open_completed = mock_open(read_data=cls._completed_status)
+
+        # Endpoint tests never read the real variants file; tests of load_variants call it directly
+        cls._load_variants_patcher = patch('app.load_variants')
+        cls.mock_load_variants = cls._load_variants_patcher.start()
+        cls.addClassCleanup(cls._load_variants_patcher.stop)
+
+        # Testing mode: errors raised by a view surface in the test instead of becoming a 500 page
+        saved_config = {key: app.config[key] for key in ('TESTING', 'PROPAGATE_EXCEPTIONS')}
+        app.config.update(TESTING=True, PROPAGATE_EXCEPTIONS=True)
+        cls.addClassCleanup(app.config.update, saved_config)
+
         # Create a test client for the Flask app
-        self.client = app.test_client()
+        cls.client = app.test_client()
+
+    def setUp(self):
+        # Forget the calls and return value left by the previous test
+        self.mock_load_variants.reset_mock(return_value=True, side_effect=True)
 
     @patch('app.pd.read_csv')
     def test_load_variants_no_file(self, mock_read_csv):
@@ -18,9 +56,10 @@ class TestApp(unittest.TestCase):
         df = load_variants('non_existent_file.tsv')
         self.assertTrue(df.empty)
 
+    @patch('app.count_comment_lines', return_value=1)
     @patch('app.pd.read_csv')
     @patch('app.os.path.exists')
-    def test_load_variants_valid_file(self, mock_exists, mock_read_csv):
+    def test_load_variants_valid_file(self, mock_exists, mock_read_csv, mock_count_comment_lines):
         # Mock 'os.path.exists' to return True for 'test_file.tsv'
         mock_exists.return_value = True
 
@@ -42,6 +81,125 @@ class TestApp(unittest.TestCase):
         self.assertIn('Frequency', df.columns)
         self.assertIn('DP', df.columns)
         self.assertListEqual(df['ID'].tolist(), ['rs1', 'rs2'])
+        self.assertIsInstance(df['Gene'].dtype, pd.CategoricalDtype)
+
+    def test_load_variants_reuses_parquet_cache(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            tsv_path = os.path.join(tmp_dir, 'annotated_variants.tsv')
+            with open(tsv_path, 'w') as tsv_file:
+                tsv_file.write("# dbSNP version: 156\n")
+                tsv_file.write("CHROM\tPOS\tID\tREF\tALT\tGene\tFrequency\tDP\n")
+                tsv_file.write("1\t100\trs1\tA\tT\tGENE1\t0.1 (gnomADe:NFE)\t[10]\n")
+
+            first = load_variants(tsv_path)
+            self.assertTrue(os.path.exists(os.path.join(tmp_dir, 'annotated_variants.cache.parquet')))
+            # The pipeline's own Parquet output next to the TSV is left alone
+            self.assertFalse(os.path.exists(os.path.join(tmp_dir, 'annotated_variants.parquet')))
+
+            # A fresh cache must be served without re-parsing the TSV
+            with patch('app.pd.read_csv') as mock_read_csv:
+                second = load_variants(tsv_path)
+                mock_read_csv.assert_not_called()
+            pd.testing.assert_frame_equal(first, second)
+            # Cached loads come back with Arrow-backed strings and categorical labels
+            self.assertEqual(second['ID'].dtype, 'string[pyarrow]')
+            self.assertIsInstance(second['Gene'].dtype, pd.CategoricalDtype)
+
+    def test_load_variants_reads_pipeline_parquet(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            parquet_path = os.path.join(tmp_dir, 'annotated_variants.parquet')
+            pd.DataFrame({
+                'CHROM': ['1', '2'],
+                'POS': pd.array([100, 200], dtype='int32'),
+                'ID': ['rs1', '.'],
+                'REF': ['A', 'G'],
+                'ALT': ['T', 'C'],
+                'Gene': ['GENE1', 'Intergenic'],
+                'Frequency': pd.array([0.1, None], dtype='Float32'),
+                'Population': ['gnomADe:NFE', None],
+                'DP': pd.array([10, None], dtype='Int32')
+            }).to_parquet(parquet_path, index=False)
+
+            with patch('app.pd.read_csv') as mock_read_csv:
+                df = load_variants(parquet_path)
+                mock_read_csv.assert_not_called()
+
+            self.assertListEqual(df['ID'].tolist(), ['rs1', '.'])
+            self.assertListEqual(df['Population'].tolist(), ['gnomADe:NFE', 'N/A'])
+            self.assertTrue(pd.isna(df['DP'].iloc[1]))
+            self.assertEqual(df['DP'].iloc[0], 10)
+
+    @patch('app.os.path.getmtime')
+    def test_get_variants_df_reloads_only_on_mtime_change(self, mock_getmtime):
+        app_module._variants_cache = None
+        self.addCleanup(setattr, app_module, '_variants_cache', None)
+        mock_getmtime.return_value = 1.0
+
+        get_variants_df()
+        get_variants_df()
+        self.assertEqual(self.mock_load_variants.call_count, 1)
+
+        # A newer TSV invalidates the shared frame
+        mock_getmtime.return_value = 2.0
+        get_variants_df()
+        self.assertEqual(self.mock_load_variants.call_count, 2)
+
+    @patch('app.os.path.getmtime', return_value=1.0)
+    def test_variants_endpoint_reuses_filter_values(self, mock_getmtime):
+        app_module._variants_cache = None
+        self.addCleanup(setattr, app_module, '_variants_cache', None)
+        self.mock_load_variants.return_value = pd.DataFrame({
+            'ID': ['rs1', 'rs2'],
+            'Frequency': pd.array([0.1, 0.6], dtype='Float32'),
+            'DP': pd.array([10, 20], dtype='Int32')
+        })
+
+        with patch('app.column_filter_values', wraps=app_module.column_filter_values) as mock_values:
+            for page in (1, 2):
+                response = self.client.get(f'/variants?frequency=0.1&frequency_operator=eq&page={page}')
+                self.assertEqual(response.get_json()['total_variants'], 1)
+            self.assertEqual(mock_values.call_count, 1)
+
+    @patch('app.os.path.getmtime', return_value=1.0)
+    def test_variants_endpoint_reuses_rendered_pages(self, mock_getmtime):
+        app_module._variants_cache = None
+        self.addCleanup(setattr, app_module, '_variants_cache', None)
+        self.mock_load_variants.return_value = pd.DataFrame({
+            'ID': ['rs1', 'rs2'],
+            'Frequency': [0.1, 0.6],
+            'DP': [10, 20]
+        })
+
+        with patch('app.build_filter_mask', wraps=app_module.build_filter_mask) as mock_build_filter_mask:
+            # Equivalent query strings share one rendered body
+            first = self.client.get('/variants?frequency=0.5')
+            second = self.client.get('/variants?frequency=0.50')
+            self.assertEqual(mock_build_filter_mask.call_count, 1)
+        self.assertEqual(first.get_data(), second.get_data())
+
+        # A newer variants file starts a fresh page cache
+        mock_getmtime.return_value = 2.0
+        with patch('app.build_filter_mask', wraps=app_module.build_filter_mask) as mock_build_filter_mask:
+            self.client.get('/variants?frequency=0.5')
+            self.assertEqual(mock_build_filter_mask.call_count, 1)
+
+    def test_status_endpoint_rereads_only_changed_file(self):
+        app_module._status_cache = None
+        self.addCleanup(setattr, app_module, '_status_cache', None)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            status_path = os.path.join(tmp_dir, 'pipeline_status.json')
+            with open(status_path, 'w') as status_file:
+                status_file.write('{"status": "running", "message": "Pipeline is running..."}')
+
+            with patch('app.STATUS_FILE_PATH', status_path):
+                self.assertEqual(self.client.get('/status').get_json()['status'], 'running')
+                with patch('app.json.load') as mock_json_load:
+                    self.assertEqual(self.client.get('/status').get_json()['status'], 'running')
+                    mock_json_load.assert_not_called()
+
+                with open(status_path, 'w') as status_file:
+                    status_file.write('{"status": "completed", "message": "Pipeline completed successfully."}')
+                self.assertEqual(self.client.get('/status').get_json()['status'], 'completed')
 
     def test_validate_query_param_valid(self):
         # Test valid parameter
@@ -53,15 +211,9 @@ class TestApp(unittest.TestCase):
         with self.assertRaises(ValueError):
             validate_query_param('1.5', 'frequency', float, min_value=0.0, max_value=1.0)
 
-    @patch('app.load_variants')
-    def test_variants_endpoint(self, mock_load_variants):
+    def test_variants_endpoint(self):
         # Mock the DataFrame returned by load_variants
-        mock_load_variants.return_value = pd.DataFrame({
-            'ID': ['rs1'],
-            'Gene': ['GENE1'],
-            'Frequency': [0.1],
-            'DP': [10]
-        })
+        self.mock_load_variants.return_value = self._df_one_row
 
         response = self.client.get('/variants?frequency=0.1&depth=10')
         self.assertEqual(response.status_code, 200)
@@ -70,25 +222,22 @@ class TestApp(unittest.TestCase):
         self.assertEqual(len(response_json['variants']), 1)
         self.assertEqual(response_json['variants'][0]['ID'], 'rs1')
 
-    @patch('app.load_variants')
-    def test_variants_endpoint_no_data(self, mock_load_variants):
+    def test_variants_endpoint_no_data(self):
         # Mock load_variants to return an empty DataFrame
-        mock_load_variants.return_value = pd.DataFrame()
+        self.mock_load_variants.return_value = self._empty_df
 
         # Mock the status file indicating completion
-        with patch('app.os.path.exists') as mock_exists, \
-             patch('builtins.open', unittest.mock.mock_open(read_data='{"status": "completed", "message": "Pipeline completed."}')):
-            mock_exists.side_effect = lambda path: path == "output/pipeline_status.json" or path == "output/annotated_variants.tsv"
-
+        existing_files = {"output/pipeline_status.json", "output/annotated_variants.parquet"}
+        with patch('app.os.path.exists', side_effect=existing_files.__contains__), \
+             patch('builtins.open', self._mock_open_completed):
             response = self.client.get('/variants?frequency=0.1&depth=10')
             self.assertEqual(response.status_code, 503)
             response_json = response.get_json()
             self.assertIn('Pipeline has completed but no data found.', response_json['message'])
 
-    @patch('app.load_variants')
-    def test_variants_endpoint_pipeline_not_run(self, mock_load_variants):
+    def test_variants_endpoint_pipeline_not_run(self):
         # Mock load_variants to return an empty DataFrame
-        mock_load_variants.return_value = pd.DataFrame()
+        self.mock_load_variants.return_value = self._empty_df
 
         # Mock the absence of the status file and variants file
         with patch('app.os.path.exists') as mock_exists:
@@ -100,16 +249,9 @@ class TestApp(unittest.TestCase):
             response_json = response.get_json()
             self.assertIn('Pipeline has not been run yet.', response_json['message'])
 
-    @patch('app.load_variants')
-    def test_variants_endpoint_invalid_sort(self, mock_load_variants):
+    def test_variants_endpoint_invalid_sort(self):
         # Mock the DataFrame returned by load_variants
-        mock_load_variants.return_value = pd.DataFrame({
-            'ID': ['rs1', 'rs2'],
-            'Gene': ['GENE1', 'GENE2'],
-            'Frequency': [0.1, 0.2],
-            'Population': ['EUR', 'AFR'],
-            'DP': [10, 20]
-        })
+        self.mock_load_variants.return_value = self._df_two_rows
 
         # Attempt to sort by an invalid column
         response = self.client.get('/variants?frequency=0.1&depth=10&sort_column=INVALID&sort_order=asc')
@@ -117,16 +259,24 @@ class TestApp(unittest.TestCase):
         response_json = response.get_json()
         self.assertIn('Invalid sort_column', response_json['message'])
 
-    @patch('app.load_variants')
-    def test_variants_endpoint_invalid_sort_order(self, mock_load_variants):
+    @patch('app.os.path.getmtime', return_value=1.0)
+    def test_variants_endpoint_does_not_cache_huge_pages(self, mock_getmtime):
+        app_module._variants_cache = None
+        self.addCleanup(setattr, app_module, '_variants_cache', None)
+        self.mock_load_variants.return_value = self._df_two_rows
+
+        # Huge pages are still served, but rendered every time rather than pinned in the page cache
+        huge_page = f'/variants?per_page={app_module.PAGE_CACHE_MAX_PER_PAGE + 1}'
+        with patch('app.build_filter_mask', wraps=app_module.build_filter_mask) as mock_build_filter_mask:
+            for _ in range(2):
+                response = self.client.get(huge_page)
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual(response.get_json()['total_variants'], 2)
+            self.assertEqual(mock_build_filter_mask.call_count, 2)
+
+    def test_variants_endpoint_invalid_sort_order(self):
         # Mock the DataFrame returned by load_variants
-        mock_load_variants.return_value = pd.DataFrame({
-            'ID': ['rs1', 'rs2'],
-            'Gene': ['GENE1', 'GENE2'],
-            'Frequency': [0.1, 0.2],
-            'Population': ['EUR', 'AFR'],
-            'DP': [10, 20]
-        })
+        self.mock_load_variants.return_value = self._df_two_rows
 
         # Attempt to use an invalid sort order
         response = self.client.get('/variants?frequency=0.1&depth=10&sort_column=Gene&sort_order=invalid')
@@ -134,5 +284,49 @@ class TestApp(unittest.TestCase):
         response_json = response.get_json()
         self.assertIn('Invalid sort_order', response_json['message'])
 
+    def test_variants_endpoint_sort_desc_keeps_missing_last(self):
+        self.mock_load_variants.return_value = pd.DataFrame({
+            'ID': ['rs1', 'rs2', 'rs3'],
+            'Gene': ['GENE1', 'GENE2', 'GENE3'],
+            'Frequency': [0.1, None, 0.3],
+            'DP': [10, 20, 30]
+        })
+
+        response = self.client.get('/variants?sort_column=Frequency&sort_order=desc&depth=15')
+        self.assertEqual(response.status_code, 200)
+        response_json = response.get_json()
+        self.assertEqual(response_json['total_variants'], 2)
+        self.assertEqual([variant['ID'] for variant in response_json['variants']], ['rs3', 'rs2'])
+
+    def test_variant_endpoint_lookup_by_id(self):
+        # load_variants indexes rows by ID
+        self.mock_load_variants.return_value = pd.DataFrame({
+            'ID': ['rs1', 'rs2'],
+            'Gene': ['GENE1', 'GENE2'],
+            'Frequency': [0.1, None],
+            'DP': [10, 20]
+        }, index=['rs1', 'rs2'])
+
+        response = self.client.get('/variants/rs2')
+        self.assertEqual(response.status_code, 200)
+        response_json = response.get_json()
+        self.assertEqual(response_json['Gene'], 'GENE2')
+        self.assertIsNone(response_json['Frequency'])
+
+        response = self.client.get('/variants/rs3')
+        self.assertEqual(response.status_code, 404)
+
+    def test_variant_endpoint_duplicate_id_returns_first(self):
+        self.mock_load_variants.return_value = pd.DataFrame({
+            'ID': ['.', '.'],
+            'Gene': ['GENE1', 'GENE2'],
+            'Frequency': [None, None],
+            'DP': [10, 20]
+        }, index=['.', '.'])
+
+        response = self.client.get('/variants/.')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_json()['Gene'], 'GENE1')
+
 if __name__ == '__main__':
     unittest.main()
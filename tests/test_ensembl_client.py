@@ -1,77 +1,103 @@
 # test_ensembl_client.py
 
+import collections
 import unittest
-from unittest.mock import patch, MagicMock
-from urllib.error import HTTPError
-from ensembl_client import EnsemblRestClient
-
-# Subclass HTTPError to allow setting headers without setting 'reason'
-class MockHTTPError(HTTPError):
-    def __init__(self, code, reason, headers=None):
-        super().__init__(
-            url='https://rest.ensembl.org/nonexistent-endpoint',
-            code=code,
-            msg=reason,     # 'reason' is derived from 'msg'
-            hdrs=headers,   # Set headers appropriately
-            fp=None
-        )
-        # Do NOT set 'self.reason' manually
+from unittest.mock import patch
+import requests
+from ensembl_client import EnsemblRestClient, PayloadTooLargeError
+
+def make_response(status_code, reason, content=b'', headers=None):
+    """Build a requests.Response as returned by the shared session."""
+    response = requests.Response()
+    response.status_code = status_code
+    response.reason = reason
+    response._content = content
+    response.headers.update(headers or {})
+    response.url = 'https://rest.ensembl.org/nonexistent-endpoint'
+    return response
 
 class TestEnsemblRestClient(unittest.TestCase):
 
+    @classmethod
+    def setUpClass(cls):
+        # Error responses shared by the tests; the client only reads them
+        cls.HTTP_404 = make_response(404, 'Not Found')
+        cls.HTTP_500 = make_response(500, 'Internal Server Error', headers={'Retry-After': '5'})
+
     def setUp(self):
         # Create an instance of the EnsemblRestClient
         self.client = EnsemblRestClient()
 
     @patch('ensembl_client.time.sleep', return_value=None)  # Mock sleep
-    @patch('ensembl_client.urlopen')
-    def test_perform_rest_action_404(self, mock_urlopen, mock_sleep):
-        # Create an instance of MockHTTPError for 404
-        mock_http_error = MockHTTPError(404, 'Not Found')
-
-        # Configure the mock to raise the HTTPError when entered
-        mock_urlopen.return_value.__enter__.side_effect = mock_http_error
+    @patch('ensembl_client.SESSION.request')
+    def test_perform_rest_action_404(self, mock_request, mock_sleep):
+        # Respond with a 404 for the endpoint
+        mock_request.return_value = self.HTTP_404
 
         # Assert that HTTPError is raised with correct attributes
-        with self.assertRaises(HTTPError) as context:
+        with self.assertRaises(requests.exceptions.HTTPError) as context:
             self.client.perform_rest_action('/nonexistent-endpoint', method='GET')
 
         # Verify exception attributes
-        self.assertEqual(context.exception.code, 404)
-        self.assertEqual(context.exception.reason, 'Not Found')
-        self.assertIsInstance(context.exception, HTTPError)
+        self.assertEqual(context.exception.response.status_code, 404)
+        self.assertEqual(context.exception.response.reason, 'Not Found')
+        # Non-retryable errors are raised on the first attempt
+        self.assertEqual(mock_request.call_count, 1)
 
-    @patch('ensembl_client.time.sleep', return_value=None)  # Mock sleep
-    @patch('ensembl_client.urlopen')
-    def test_perform_rest_action_500(self, mock_urlopen, mock_sleep):
-        # Create an instance of MockHTTPError for 500 with headers
-        mock_http_error = MockHTTPError(500, 'Internal Server Error', headers={'Retry-After': '5'})
+    @patch('ensembl_client.SESSION.request')
+    def test_perform_rest_action_413(self, mock_request):
+        # An oversized body is reported to the caller instead of being retried
+        mock_request.return_value = make_response(413, 'Payload Too Large')
+
+        with self.assertRaises(PayloadTooLargeError) as context:
+            self.client.perform_rest_action('/vep/human/region', method='POST', data={'variants': []})
 
-        # Configure the mock to raise the HTTPError when entered
-        mock_urlopen.return_value.__enter__.side_effect = mock_http_error
+        self.assertEqual(context.exception.response.status_code, 413)
+        self.assertEqual(mock_request.call_count, 1)
+
+    @patch('ensembl_client.time.sleep', return_value=None)  # Mock sleep
+    @patch('ensembl_client.SESSION.request')
+    def test_perform_rest_action_500(self, mock_request, mock_sleep):
+        # Respond with a 500 and a Retry-After header on every attempt
+        mock_request.return_value = self.HTTP_500
 
         # Assert that HTTPError is raised with correct attributes
-        with self.assertRaises(HTTPError) as context:
+        with self.assertRaises(requests.exceptions.HTTPError) as context:
             self.client.perform_rest_action('/server-error-endpoint', method='GET')
 
         # Verify exception attributes
-        self.assertEqual(context.exception.code, 500)
-        self.assertEqual(context.exception.reason, 'Internal Server Error')
-        self.assertEqual(context.exception.headers['Retry-After'], '5')
+        self.assertEqual(context.exception.response.status_code, 500)
+        self.assertEqual(context.exception.response.reason, 'Internal Server Error')
+        self.assertEqual(context.exception.response.headers['Retry-After'], '5')
 
     @patch('ensembl_client.time.sleep', return_value=None)  # Mock sleep
-    @patch('ensembl_client.urlopen')
-    def test_perform_rest_action_get(self, mock_urlopen, mock_sleep):
+    @patch('ensembl_client.SESSION.request')
+    def test_perform_rest_action_get(self, mock_request, mock_sleep):
         # Mock a successful GET request
-        mock_response = MagicMock()
-        mock_response.read.return_value = '{"gene": "BRCA1"}'
-        mock_response.getcode.return_value = 200
-
-        # Mock the context manager's __enter__ method to return mock_response
-        mock_urlopen.return_value.__enter__.return_value = mock_response
+        mock_request.return_value = make_response(200, 'OK', content=b'{"gene": "BRCA1"}')
 
-        result = self.client.perform_rest_action('/some-endpoint', method='GET')
+        result = self.client.perform_rest_action('/some-endpoint', method='GET', params={'pops': '1'})
         self.assertEqual(result['gene'], 'BRCA1')
+        self.assertEqual(mock_request.call_args.kwargs['params'], {'pops': '1'})
+
+    def test_rate_limit_waits_for_oldest_request(self):
+        # A fake clock that only moves when the limiter sleeps
+        clock = [100.0]
+        def fake_sleep(seconds):
+            clock[0] += seconds
+        client = EnsemblRestClient(reqs_per_sec=2)
+        with patch.object(EnsemblRestClient, '_request_times', collections.deque()), \
+                patch('ensembl_client.time.monotonic', side_effect=lambda: clock[0]), \
+                patch('ensembl_client.time.sleep', side_effect=fake_sleep) as mock_sleep:
+            client._check_rate_limit()
+            clock[0] += 0.25
+            client._check_rate_limit()
+            mock_sleep.assert_not_called()
+
+            # The third request waits until the first one is a second old
+            client._check_rate_limit()
+            mock_sleep.assert_called_once_with(0.75)
+            self.assertEqual(list(EnsemblRestClient._request_times), [100.25, 101.0])
 
 if __name__ == '__main__':
     unittest.main()
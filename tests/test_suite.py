@@ -1,27 +1,18 @@
-import unittest
-from test_app import TestApp
-from test_ensembl_client import TestEnsemblRestClient
-from test_annotate_variants import TestAnnotateVariants
+import importlib.util
+import os
+import sys
 
-print("Running test suite...")  # Add this line to see if the script runs
+import pytest
 
-# Create a test suite combining different test cases
-def suite():
-    suite = unittest.TestSuite()
+# Runs every test module in this directory through pytest. With pytest-xdist installed the
+# test classes are spread over one worker process per CPU; they share no state, so order doesn't matter.
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
 
-    # Add test cases from test_app.py
-    suite.addTest(unittest.makeSuite(TestApp))
-    
-    # Add test cases from test_ensembl_client.py
-    suite.addTest(unittest.makeSuite(TestEnsemblRestClient))
-
-    # Add test cases from test_annotate_variants.py
-    suite.addTest(unittest.makeSuite(TestAnnotateVariants))
-
-    return suite
+def main():
+    args = [TESTS_DIR, '-q']
+    if importlib.util.find_spec('xdist') is not None:
+        args += ['-n', 'auto']
+    return pytest.main(args + sys.argv[1:])
 
 if __name__ == '__main__':
-    print("Starting the test runner...")  # Add this line to check if the runner starts
-    # Run the test suite
-    runner = unittest.TextTestRunner(verbosity=2)
-    runner.run(suite())
+    sys.exit(main())